@@ -1,20 +1,40 @@
+import asyncio
+import collections
+from functools import partial
 from math import factorial
 from math import floor
-
+import multiprocessing
 import numpy
 import itertools
 
-from KitoboDatabase import KitoboDatabase
+import BatchedLoadStatistics as bls
+from AsyncKitoboDatabase import AsyncKitoboDatabase
+from KitoboDatabase import KitoboDatabase, getMetric, statisticFields
+from KitoboBackends import MongoBackend, CacheBackend
+from LoadCache import LoadCache
+from RunningStatistics import ConvergenceMonitor, ConfidenceMonitor
+import Instrumentation
 
 class AggregateStatisticCalculator:
 
-    def __init__(self,dataSource,samplingInterval,statistic,statisticParameters=[],maxIterations=1000,tol=0.0001):
-        if not (dataSource in ['kitobo']):
+    def __init__(self,dataSource,samplingInterval,statistic,statisticParameters=[],maxIterations=1000,tol=0.0001,inMemory=False,cacheDirectory=None,serverSide=False,chunkSize=None,windows=None,instrumentation=None,
+                 targetWidth=None,confidence=0.95,quantile=None,antithetic=False,complements=False):
+        # dataSource is 'kitobo' (the Kitobo Mongo server), 'kitoboCache' (readings from
+        # the load cache in cacheDirectory, results kept in process) or a backend object
+        # of KitoboBackends
+        if isinstance(dataSource, str) and not (dataSource in ['kitobo', 'kitoboCache']):
             raise ArgumentException('Data source not recognized')
-        if not (statistic in [
-            'autocorrelation', 'cov', 'loadFactor', 'loadFactorPercentile'
-        ]):
-            raise ArgumentException('Statistic not recognized')
+        # statistic is a statistic name, or a list of names to compute in the same
+        # sampling pass, with statisticParameters then the list of their parameters
+        if isinstance(statistic, str):
+            statistics = [(statistic, statisticParameters)]
+        else:
+            statistics = list(zip(statistic, statisticParameters or [[] for s in statistic]))
+        for s, p in statistics:
+            if not (s in [
+                'acf', 'autocorrelation', 'cov', 'loadFactor', 'loadFactorPercentile'
+            ]):
+                raise ArgumentException('Statistic not recognized')
         if not (samplingInterval in [
             'second', 'fiveSeconds', 'fifteenSeconds', 'minute',
             'fiveMinutes', 'fifteenMinutes', 'hour', 'day', 'week', 'month',
@@ -26,83 +46,477 @@ class AggregateStatisticCalculator:
         self.samplingInterval = samplingInterval
         self.statistic = statistic
         self.statisticParameters = statisticParameters
+        self.statistics = statistics  # (statistic, statisticParameters) pairs
         self.maxIterations = maxIterations
         self.tol = tol
+        self.inMemory = inMemory  # Load the raw readings once and compute statistics locally
+        self.cacheDirectory = cacheDirectory  # Local cache of the raw readings (see LoadCache)
+        self.serverSide = serverSide  # Compute statistics in the Mongo pipeline when not in memory
+        self.chunkSize = chunkSize  # Stream in-memory statistics over chunks of this many timestamps
+        self.windows = windows  # (startTime, endTime) pairs to analyze (see monthlyWindows), or None for the default one
+        self.convergence = {}  # ConvergenceMonitor of each (k, metric name)
+        # Timers and counters of the sampling loop and the database (see Instrumentation)
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation.disabled
+        # With targetWidth, sampling of a level stops once the confidence interval (at the
+        # confidence level) of the mean of each metric, or of its quantile if given, is
+        # at most targetWidth wide relative to the estimate (see ConfidenceMonitor),
+        # instead of the tol rule. Levels with few combinations then take few samples
+        # and the budget goes to the levels that need it, up to maxIterations each
+        self.targetWidth = targetWidth
+        self.confidence = confidence
+        self.quantile = quantile
+        # Draw random samples in antithetic pairs (see bls.antitheticCombination)
+        self.antithetic = antithetic
+        # With batches, also store the complement of each random sample of a level k < N/2
+        # as a sample of level N-k, its aggregate being the all-user total minus that of
+        # the sample (see storeComplements)
+        self.complements = complements
 
     def connect(self):
         if (self.dataSource == 'kitobo'):
-            self.db = KitoboDatabase()
-            self.db.connect()
-            self.db.setupLoadAggregationCalculations(samplingInterval=self.samplingInterval)
-            self.N = self.db.getNumberUsers()
+            backend = MongoBackend()
+        elif (self.dataSource == 'kitoboCache'):
+            backend = CacheBackend(self.cacheDirectory)
+        else:
+            backend = self.dataSource
+        self.db = KitoboDatabase(backend,self.instrumentation)
+        self.db.connect()
+        self.db.setupLoadAggregationCalculations(samplingInterval=self.samplingInterval,inMemory=self.inMemory,
+            cacheDirectory=None if backend.requiresInMemory else self.cacheDirectory,serverSide=self.serverSide,
+            chunkSize=self.chunkSize,windows=self.windows)
+        self.inMemory = self.db.inMemory
+        self.N = self.db.getNumberUsers()
 
     def disconnect(self):
-        self.db.disconnect
+        self.db.disconnect()
 
-    def generateSamples(self,startK=1):
+    def generateSamples(self,startK=1,batchSize=1):
+        # Several windows are sampled together, in batches
+        if len(self.db.windows) > 1:
+            return self.generateSamplesWindows(startK,batchSize if batchSize > 1 else 100)
+        # With an in-memory load matrix, batchSize > 1 evaluates the samples of each
+        # level in batches with a single selection-matrix product per batch
+        if self.inMemory and batchSize > 1:
+            return self.generateSamplesBatched(startK,batchSize)
 
-        metricName = self.statistic
-        if (self.statistic == 'autocorrelation'):
+        metricNames = self.getMetricNames()
+        # Each calculateStatistic returns the value of the metric convergence is checked on
+        # (the list of values of all the metrics, with several statistics)
+        if (len(self.statistics) > 1):
+            # All the statistics come from one aggregation of each sample
+            calculateStatistic = lambda ind,numIter: [
+                getMetric(self.db.calculateStatistics(ind,self.statistics,metricNames,sampleIndex=numIter),metricName)
+                for metricName in metricNames
+            ]
+        elif (self.statistic == 'autocorrelation'):
             calculateStatistic = lambda ind,numIter: self.db.calculateAutocorrelation(ind,self.statisticParameters[0],sampleIndex=numIter)
-            metricName = 'autocorrelation_{}'.format(self.statisticParameters[0])
+        elif (self.statistic == 'acf'):
+            calculateStatistic = lambda ind,numIter: self.db.calculateAutocorrelationFunction(ind,self.statisticParameters[0],sampleIndex=numIter)[-1]
         elif (self.statistic == 'loadFactor'):
-            calculateStatistic = lambda ind,numIter: self.db.calculateAggregateLoadStats(ind,sampleIndex=numIter)
+            calculateStatistic = lambda ind,numIter: self.db.calculateAggregateLoadStats(ind,sampleIndex=numIter)['loadFactor']
         elif (self.statistic == 'cov'):
             calculateStatistic = lambda ind,numIter: self.db.calculateCOV(ind,sampleIndex=numIter)
         elif (self.statistic == 'loadFactorPercentile'):
             calculateStatistic = lambda ind, numIter: (
                 self.db.calculateLoadFactorPercentile(
                     ind, self.statisticParameters[0], sampleIndex=numIter
-                )
-            )
-            metricName = 'loadFactor_{}'.format(
-                self.statisticParameters[0][-1]  # Use the last percentile
+                )[-1]
             )
 
         for k in range(startK,self.N+1):
             print('k={}'.format(k))
+            self.instrumentation.setLevel(k)
             sampleList = self.db.getSampleList(k) #Sample list saves a randomly generated list of load profiles that are sampled
-            numIter = 0
             numCombinations = floor(factorial(self.N)/factorial(k)/factorial(self.N-k))
 
-            prevStdDev = 0
-            prevT = self.tol
-            while numIter < min(self.maxIterations,numCombinations): #change to check OR convergence in standard deviation
+            #When every combination fits in the budget they are enumerated in
+            #revolving-door order, rather than drawn at random until none is left
+            enumeration = bls.revolvingDoorCombinations(self.N,k) if numCombinations <= self.maxIterations else None
+
+            #Samples already stored by a previous run are not recomputed
+            monitors = self.resumeConvergence(k,metricNames,sampleList)
+            numIter = monitors[0].stats.count
+            while numIter < min(self.maxIterations,numCombinations) and not allConverged(monitors):
                 #Find a sample that hasn't been used before
                 if (numIter >= len(sampleList)): #then we need to generate new samples
-                    while True:
-                        ind = [int(x) for x in sorted(numpy.random.choice(numpy.arange(0, self.N), size=k, replace=False))]
-                        if ind not in sampleList:
-                            sampleList = self.db.appendSample(k,ind)
-                            break
+                    ind = self.drawSample(k,enumeration)
+                    if ind is None: #every combination has been evaluated
+                        break
                 else:
                     ind = sampleList[numIter]
                 try:
-                    calculateStatistic(ind,numIter)
+                    values = calculateStatistic(ind,numIter)
                 except IndexError:
                     self.db.removeSample(k,ind)
                     sampleList = self.db.getSampleList(k)
                     print('Invalid ind: ' + str(ind))
                     continue
 
-                newStdDev = self.db.calculateMetricStdDev(k,numIter,metricName)
+                if numIter % 100 == 0:
+                    print('k='+str(k)+',numIter='+str(numIter))
+                if updateConvergence(monitors, values if len(metricNames) > 1 else [values]):
+                    break
+
+                numIter += 1
+            self.instrumentation.writeLevel(k)
+
+    # Runs the sampling of generateSamples with up to maxInFlight samples being evaluated
+    # concurrently, through the asyncio front end of the database (AsyncKitoboDatabase).
+    # Samples are drawn in the same order as generateSamples, and their results are
+    # stored and fed to the convergence check in that order, so a run gives the same
+    # results; only the round-trips to the database overlap
+    def generateSamplesAsync(self,startK=1,maxInFlight=8):
+        asyncio.run(self.sampleLevelsAsync(startK,maxInFlight))
+
+    async def sampleLevelsAsync(self,startK,maxInFlight):
+
+        metricNames = self.getMetricNames()
+        adb = AsyncKitoboDatabase(self.db,maxInFlight)
+        try:
+            for k in range(startK,self.N+1):
+                print('k={}'.format(k))
+                self.instrumentation.setLevel(k)
+                sampleList = self.db.getSampleList(k)
+                numCombinations = floor(factorial(self.N)/factorial(k)/factorial(self.N-k))
+                maxIter = min(self.maxIterations,numCombinations)
+                enumeration = bls.revolvingDoorCombinations(self.N,k) if numCombinations <= self.maxIterations else None
+
+                monitors = self.resumeConvergence(k,metricNames,sampleList)
+                numIter = monitors[0].stats.count
+                inFlight = collections.deque()  # (ind, task) in order of sample index
+                drawn = {}  # Samples drawn by this run, with the RNG state before their draw
+                exhausted = False
+                while True:
+                    #Keep up to maxInFlight samples in flight, within the budget of the level
+                    while (not exhausted and not allConverged(monitors) and len(inFlight) < maxInFlight
+                            and numIter + len(inFlight) < maxIter):
+                        j = numIter + len(inFlight)
+                        if j < len(sampleList):
+                            ind = sampleList[j]
+                        else:
+                            state = numpy.random.get_state()
+                            ind = self.drawSample(k,enumeration)
+                            if ind is None:
+                                exhausted = True
+                                break
+                            drawn[tuple(ind)] = state
+                        inFlight.append((ind, asyncio.ensure_future(adb.evaluate(ind,self.statistics,metricNames,j))))
+                    if not inFlight or allConverged(monitors):
+                        break
+
+                    ind, task = inFlight.popleft()
+                    try:
+                        fields, computed = await task
+                    except IndexError:
+                        #The samples after it move down one index, as in generateSamples
+                        self.db.removeSample(k,ind)
+                        print('Invalid ind: ' + str(ind))
+                        continue
+                    if computed:
+                        self.db.saveStats(ind,numIter,fields)
+                    await adb.flushIfDue()
 
-                if prevStdDev > 0:
-                    t = abs(newStdDev-prevStdDev)/prevStdDev
                     if numIter % 100 == 0:
                         print('k='+str(k)+',numIter='+str(numIter))
+                    if updateConvergence(monitors, [getMetric(fields,metricName) for metricName in metricNames]):
+                        continue
+
+                    numIter += 1
+
+                #Samples still in flight once the level has converged are dropped. Those
+                #this run drew are removed from the sample list, and the RNG is put back
+                #as it was before the first of them, so that the next levels draw the
+                #same samples as generateSamples
+                for ind, task in reversed(inFlight):
+                    task.cancel()
+                    if tuple(ind) in drawn:
+                        self.db.removeSample(k,ind)
+                        numpy.random.set_state(drawn[tuple(ind)])
+                await asyncio.gather(*[task for ind, task in inFlight], return_exceptions=True)
+                await adb.flush()
+                self.instrumentation.writeLevel(k)
+        finally:
+            adb.close()
+
+    def generateSamplesBatched(self,startK=1,batchSize=100):
+
+        metricNames = self.getMetricNames()
+
+        # All-user totals of the window, from which the complements of the samples are
+        # derived (unless the statistics are streamed over chunks)
+        totals = None
+        if self.complements and self.db.chunkSize is None:
+            totals = bls.LoadTotals(self.db.loadMatrix, self.db.loadMask)
 
-                    if t < self.tol and prevT < self.tol:
+        for k in range(startK,self.N+1):
+            print('k={}'.format(k))
+            self.instrumentation.setLevel(k)
+            sampleList = self.db.getSampleList(k)
+            numCombinations = floor(factorial(self.N)/factorial(k)/factorial(self.N-k))
+            maxIter = min(self.maxIterations,numCombinations)
+
+            exhaustive = numCombinations <= self.maxIterations
+
+            monitors = self.resumeConvergence(k,metricNames,sampleList)
+            numIter = monitors[0].stats.count
+            while numIter < maxIter and not allConverged(monitors):
+                #Collect the next batch of samples, generating new ones as needed. Only
+                #samples with aggregate data are kept, so sample indexes do not shift
+                inds = []
+                while len(inds) < min(batchSize,maxIter-numIter):
+                    j = numIter + len(inds)
+                    if (j >= len(sampleList) and exhaustive):
+                        break
+                    elif (j >= len(sampleList)):
+                        pair = True
+                        while True:
+                            ind = randomCombination(self.N,k,sampleList,self.antithetic and pair)
+                            if not self.db.hasSample(k,ind) and self.db.hasAggregateData(ind):
+                                sampleList = self.db.appendSample(k,ind)
+                                break
+                            pair = False
+                    else:
+                        ind = sampleList[j]
+                        if not self.db.hasAggregateData(ind):
+                            self.db.removeSample(k,ind)
+                            sampleList = self.db.getSampleList(k)
+                            print('Invalid ind: ' + str(ind))
+                            continue
+                    inds.append(ind)
+                if not inds:
+                    break
+
+                if totals is not None and 2*k < self.N and not exhaustive:
+                    with self.instrumentation.phase('aggregation'):
+                        profiles, valid, complementProfiles, complementValid = totals.withComplements(inds)
+                    fields = self.db.calculateStatisticBatch(inds,self.statistics,
+                        list(range(numIter,numIter+len(inds))),profiles,valid)
+                    self.storeComplements(k,inds,complementProfiles,complementValid)
+                else:
+                    fields = self.db.calculateStatisticBatch(inds,self.statistics,
+                        list(range(numIter,numIter+len(inds))))
+
+                for f in fields:
+                    if numIter % 100 == 0:
+                        print('k='+str(k)+',numIter='+str(numIter))
+                    if updateConvergence(monitors, [getMetric(f,metricName) for metricName in metricNames]):
                         break
-                    prevT = t
 
-                prevStdDev = newStdDev
+                    numIter += 1
+
+            #Once the stored samples are evaluated, the remaining combinations are enumerated
+            if exhaustive:
+                self.enumerateLevel(k,metricNames,monitors,numIter,batchSize)
+            self.instrumentation.writeLevel(k)
+
+    #Runs the sampling of generateSamplesBatched over every window of the database at
+    #once: the same samples are drawn for all the windows, and each batch is aggregated
+    #once over their span with its statistics computed and stored per window (see
+    #calculateStatisticBatchWindows). A level is sampled until its metrics have
+    #converged in every window. Requires the in-memory load matrix
+    def generateSamplesWindows(self,startK=1,batchSize=100):
+
+        metricNames = self.getMetricNames()
+        windows = range(len(self.db.windows))
+
+        for k in range(startK,self.N+1):
+            print('k={}'.format(k))
+            self.instrumentation.setLevel(k)
+            sampleList = self.db.getSampleList(k)
+            numCombinations = floor(factorial(self.N)/factorial(k)/factorial(self.N-k))
+            maxIter = min(self.maxIterations,numCombinations)
+            enumeration = bls.revolvingDoorCombinations(self.N,k) if numCombinations <= self.maxIterations else None
+
+            #A previous run may have stored more samples in some windows than in others;
+            #sampling resumes after those stored in every window still converging
+            monitors = []
+            for w in windows:
+                self.db.selectWindow(w)
+                monitors.append(self.resumeConvergence(k,metricNames,sampleList))
+            counts = [m[0].stats.count for m in monitors if not allConverged(m)]
+            numIter = min(counts) if counts else maxIter
+            while numIter < maxIter and not all(allConverged(m) for m in monitors):
+                inds = []
+                while len(inds) < min(batchSize,maxIter-numIter):
+                    j = numIter + len(inds)
+                    if j < len(sampleList):
+                        ind = sampleList[j]
+                    else:
+                        ind = self.drawSample(k,enumeration)
+                        if ind is None: #every combination has been evaluated
+                            break
+                    #Only samples with aggregate data in every window are kept
+                    if not self.db.hasAggregateData(ind):
+                        self.db.removeSample(k,ind)
+                        sampleList = self.db.getSampleList(k)
+                        print('Invalid ind: ' + str(ind))
+                        continue
+                    inds.append(ind)
+                if not inds:
+                    break
+
+                fieldsByWindow = self.db.calculateStatisticBatchWindows(inds,self.statistics,
+                    list(range(numIter,numIter+len(inds))))
+
+                for i in range(len(inds)):
+                    if numIter % 100 == 0:
+                        print('k='+str(k)+',numIter='+str(numIter))
+                    #A window whose monitors already saw this sample on resume skips it
+                    for w in windows:
+                        if not allConverged(monitors[w]) and monitors[w][0].stats.count == numIter:
+                            updateConvergence(monitors[w], [getMetric(fieldsByWindow[w][i],metricName) for metricName in metricNames])
+                    numIter += 1
+                    if all(allConverged(m) for m in monitors):
+                        break
+            self.instrumentation.writeLevel(k)
+
+        self.db.selectWindow(0)
+
+    #Evaluates, in revolving-door order, every combination of k users not yet in the
+    #sample list of level k, starting at sample index numIter, until the metrics have
+    #converged. Consecutive combinations differ by one user, so each aggregate profile
+    #is updated from the previous one instead of being summed from scratch
+    def enumerateLevel(self,k,metricNames,monitors,numIter,batchSize=100):
+
+        for combinations, profiles, valid in bls.enumerateProfiles(self.db.loadMatrix,k,self.db.loadMask,batchSize):
+            if allConverged(monitors):
+                break
+            #Only samples with aggregate data are kept, as in generateSamplesBatched
+            keep = [valid[i].any() and not self.db.hasSample(k,c) for i, c in enumerate(combinations.tolist())]
+            inds = [c for c, kept in zip(combinations.tolist(), keep) if kept]
+            if not inds:
+                continue
+            for ind in inds:
+                self.db.appendSample(k,ind)
+
+            fields = self.db.calculateStatisticBatch(inds,self.statistics,
+                list(range(numIter,numIter+len(inds))),profiles[keep],valid[keep])
+
+            for f in fields:
+                if numIter % 100 == 0:
+                    print('k='+str(k)+',numIter='+str(numIter))
+                if updateConvergence(monitors, [getMetric(f,metricName) for metricName in metricNames]):
+                    break
 
                 numIter += 1
 
-    def getSamplesByNumberUsers(self, metricNames=[]):
+    # Runs the sampling of generateSamples with the aggregation levels spread over a
+    # pool of numWorkers processes sharing the read-only load matrix (memory-mapped from
+    # the load cache when there is one). Each level draws its samples from its own RNG
+    # stream seeded by (seed, k), and the results are stored in order of k, so a run is
+    # reproducible and gives the same samples whatever the number of workers.
+    # Requires the in-memory load matrix
+    def generateSamplesParallel(self,startK=1,numWorkers=None,seed=0,batchSize=100):
+
+        metricNames = self.getMetricNames()
+        tasks = [
+            (k, self.N, self.statistics, metricNames,
+             self.maxIterations, self.monitorFactory(k), seed, list(self.db.getSampleList(k)), batchSize,
+             self.chunkSize, self.antithetic)
+            for k in range(startK,self.N+1)
+        ]
+        if self.db.cache is not None:
+            cols = self.db.windowColumns(self.db.window)
+            initArgs = (None, None, self.db.cache.directory, self.db.cacheEntry, (cols.start, cols.stop))
+        else:
+            initArgs = (self.db.loadMatrix, self.db.loadMask)
+
+        with multiprocessing.Pool(numWorkers, initializer=initSamplingWorker, initargs=initArgs) as pool:
+            for k, sampleList, fields, removed in pool.imap(sampleLevel, tasks):
+                print('k={}'.format(k))
+                self.instrumentation.setLevel(k)
+                for ind in removed:
+                    self.db.removeSample(k,ind)
+                for ind in sampleList[len(self.db.getSampleList(k)):]:
+                    self.db.appendSample(k,ind)
+                for i, ind in enumerate(sampleList):
+                    self.db.saveStats(ind, i, fields[i])
+                self.instrumentation.writeLevel(k)
+
+    # Stores the complements of the samples inds of level k as new samples of level N-k,
+    # with their statistics computed from the complement profiles (and valid time points)
+    # already derived from the all-user total. A complement of a uniformly random sample
+    # is a uniformly random sample of level N-k, so the sampling of that level resumes
+    # from them as from samples of a previous run. Complements already sampled, without
+    # aggregate data, or past the maxIterations budget of the level are skipped
+    def storeComplements(self,k,inds,profiles,valid):
+        K = self.N - k
+        sampleList = self.db.getSampleList(K)
+        start = len(sampleList)
+        keep = []
+        complements = []
+        for i, ind in enumerate(inds):
+            members = set(ind)
+            complement = [j for j in range(self.N) if j not in members]
+            if len(sampleList) >= self.maxIterations:
+                break
+            if valid[i].any() and not self.db.hasSample(K,complement):
+                sampleList = self.db.appendSample(K,complement)
+                keep.append(i)
+                complements.append(complement)
+        if complements:
+            self.db.calculateStatisticBatch(complements,self.statistics,list(range(start,start+len(complements))),
+                profiles[keep],valid[keep])
+
+    # Returns a new sample of level k, appended to its sample list: the next combination
+    # not in the list from enumeration if given, otherwise a random one (the antithetic
+    # partner of the previous one for every other sample with antithetic sampling).
+    # Returns None once the enumeration is exhausted
+    def drawSample(self,k,enumeration=None):
+        with self.instrumentation.phase('drawSample'):
+            if enumeration is not None:
+                ind = next((list(c) for c in enumeration if not self.db.hasSample(k,list(c))), None)
+            else:
+                pair = self.antithetic
+                while True:
+                    ind = randomCombination(self.N,k,self.db.getSampleList(k),pair)
+                    if not self.db.hasSample(k,ind):
+                        break
+                    pair = False
+        if ind is not None:
+            self.db.appendSample(k,ind)
+        return ind
+
+    # Returns a function creating the convergence monitor of a metric of level k: a
+    # ConfidenceMonitor with targetWidth, otherwise a ConvergenceMonitor with tol. Samples
+    # are averaged in antithetic pairs only at levels that are sampled at random
+    def monitorFactory(self,k):
+        if self.targetWidth is None:
+            return partial(ConvergenceMonitor, self.tol)
+        numCombinations = floor(factorial(self.N)/factorial(k)/factorial(self.N-k))
+        return partial(ConfidenceMonitor, self.targetWidth, self.confidence, self.quantile,
+                       population=numCombinations, pairs=self.antithetic and numCombinations > self.maxIterations)
+
+    # Names of the stored fields that convergence is checked on, one per statistic
+    def getMetricNames(self):
+        return [statisticMetricName(s, p) for s, p in self.statistics]
+
+    # Returns the convergence monitors of level k, one per metric of metricNames, seeded
+    # with the metrics of the samples of sampleList already stored (in order of sample
+    # index, up to the first one missing a metric), as if the sampling loop had just
+    # evaluated them. All the stored results of the level are loaded in one query, so
+    # that the samples already computed are then skipped without further lookups
+    def resumeConvergence(self,k,metricNames,sampleList):
+        self.db.prefetchStats(k)
+        newMonitor = self.monitorFactory(k)
+        monitors = [newMonitor() for metricName in metricNames]
+        for metricName, monitor in zip(metricNames, monitors):
+            self.convergence[(k,metricName)] = monitor
+
+        with self.instrumentation.phase('resumeConvergence'):
+            stored = [self.db.getStoredMetrics(k,metricName) for metricName in metricNames]
+            for i in range(len(sampleList)):
+                if any(i not in s for s in stored) or updateConvergence(monitors, [s[i] for s in stored]):
+                    break
+        return monitors
+
+    # The stored metrics of every level, for the current window of the database, or for
+    # window (an index in the windows analyzed) if given
+    def getSamplesByNumberUsers(self, metricNames=[], window=None):
         if (metricNames == []):
-            metricNames = self.statistic
+            metricNames = self.getMetricNames()
+        if window is not None:
+            self.db.selectWindow(window)
         samples = []
         for k in range(1,self.N+1):
             samples.append(self.db.getMetricSamples(k, metricNames))
@@ -115,3 +529,102 @@ class AggregateStatisticCalculator:
             basicStats.append(self.db.getSampleStats(k))
 
         return basicStats
+
+
+# Name of the stored field of a statistic that its convergence is checked on
+def statisticMetricName(statistic, statisticParameters):
+    if (statistic == 'autocorrelation'):
+        return 'autocorrelation_{}'.format(statisticParameters[0])
+    elif (statistic == 'acf'):
+        return 'acf.{}'.format(len(statisticParameters[0])-1)  # Use the last lag
+    elif (statistic == 'loadFactorPercentile'):
+        return 'loadFactor_{}'.format(
+            statisticParameters[0][-1]  # Use the last percentile
+        )
+    return statistic
+
+# Draws a random combination of k out of N users, sorted, for a level whose samples
+# are in sampleList. With pair, every other sample is the antithetic partner of the
+# one before it (see bls.antitheticCombination), so that consecutive samples come in
+# pairs; callers draw again without pair if the partner cannot be used.
+def randomCombination(N, k, sampleList, pair=False, rng=numpy.random):
+    if pair and len(sampleList) % 2 == 1:
+        return [int(x) for x in bls.antitheticCombination(sampleList[-1], N, rng)]
+    return [int(x) for x in sorted(rng.choice(numpy.arange(0, N), size=k, replace=False))]
+
+# Adds the metrics of the next sample to their convergence monitors. Sampling of a
+# level stops once every metric has converged
+def updateConvergence(monitors, values):
+    for monitor, value in zip(monitors, values):
+        monitor.update(value)
+    return allConverged(monitors)
+
+def allConverged(monitors):
+    return all(monitor.converged for monitor in monitors)
+
+# Load matrix shared by the sampling worker processes
+workerLoads = {}
+
+def initSamplingWorker(loadMatrix, loadMask, cacheDirectory=None, cacheEntry=None, columns=None):
+    if cacheDirectory is not None:
+        loadMatrix, loadMask, times, deviceIds, meta = LoadCache(cacheDirectory).read(cacheEntry)
+        # The columns of the current window in the cached span
+        loadMatrix = loadMatrix[:, columns[0]:columns[1]]
+        loadMask = loadMask[:, columns[0]:columns[1]]
+    workerLoads['matrix'] = loadMatrix
+    workerLoads['mask'] = loadMask
+
+# Draws and evaluates the samples of one aggregation level k in a worker process,
+# with the same sample selection and convergence rule as generateSamplesBatched.
+# Existing samples of the level (from a previous run) are evaluated first. Returns
+# k, the list of samples evaluated, the fields to store for each of them and the
+# existing samples that were dropped for having no aggregate data
+def sampleLevel(task):
+    k, N, statistics, metricNames, maxIterations, newMonitor, seed, sampleList, batchSize, chunkSize, antithetic = task
+    rng = numpy.random.default_rng(numpy.random.SeedSequence([seed, k]))
+    loadMatrix = workerLoads['matrix']
+    loadMask = workerLoads['mask']
+    hasData = lambda ind: bool(loadMask[ind, :].all(axis=0).any())
+
+    removed = [ind for ind in sampleList if not hasData(ind)]
+    sampleList = [ind for ind in sampleList if hasData(ind)]
+    drawn = set(tuple(ind) for ind in sampleList)
+    numCombinations = floor(factorial(N)/factorial(k)/factorial(N-k))
+    maxIter = min(maxIterations,numCombinations)
+    enumeration = bls.revolvingDoorCombinations(N,k) if numCombinations <= maxIterations else None
+
+    fields = []
+    monitors = [newMonitor() for metricName in metricNames]
+    numIter = 0
+    pair = antithetic
+    while numIter < maxIter and not allConverged(monitors):
+        inds = []
+        while len(inds) < min(batchSize,maxIter-numIter):
+            j = numIter + len(inds)
+            if j < len(sampleList):
+                inds.append(sampleList[j])
+                continue
+            if enumeration is not None:
+                ind = next((list(c) for c in enumeration if c not in drawn and hasData(list(c))), None)
+                if ind is None:
+                    break
+            else:
+                ind = randomCombination(N, k, sampleList, pair, rng)
+            if tuple(ind) not in drawn and hasData(ind):
+                drawn.add(tuple(ind))
+                sampleList.append(ind)
+                inds.append(ind)
+                pair = antithetic
+            else:
+                pair = False
+        if not inds:
+            break
+
+        for f in statisticFields(loadMatrix, loadMask, inds, statistics, chunkSize):
+            fields.append(f)
+            if updateConvergence(monitors, [getMetric(f, metricName) for metricName in metricNames]):
+                break
+
+            numIter += 1
+
+    return k, sampleList[:len(fields)], fields, removed
@@ -10,16 +10,24 @@ sys.path.append('C:\\Users\\mohini\\Documents\\LoadModelingAndAgg\\pecan_street\
 
 import datetime as dat
 from datetime import timezone
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import PecanPy.pecanpy as pecanpy
 import scipy.stats as stats
 import scipy as sp
-import itertools
 import numpy.random as random
-from matplotlib.pyplot import cm
 import configparser as cp
+# Only needed to query the Pecan Street database and to plot (in the
+# notebooks), so that the statistics below also run offline without them
+try:
+    import PecanPy.pecanpy as pecanpy
+except ImportError:
+    pecanpy = None
+try:
+    import matplotlib.pyplot as plt
+    from matplotlib.pyplot import cm
+except ImportError:
+    plt = cm = None
+import BatchedLoadStatistics as bls
+from RunningStatistics import ConfidenceMonitor
 
 # The following function allows us to efficiently compute different aggregate statistics on
 # many samples of aggregated load.
@@ -42,9 +50,11 @@ def aggLoadStats(loadMat, aggLevels, statList, statArgs=None, samplesPerLevel=10
 
     nAggLevels = np.size(aggLevels);
     numStats = len(statList);
+    loads = loadArray(loadMat);
+    timeIndex = bls.DatasetIndex(loadMat.columns);
 
     # Set up the matrix for gathering results.
-    loadStats = np.nan*np.ones([nAggLevels, samplesPerLevel, numStats]);
+    loadStats = np.nan*np.ones([nAggLevels, samplesPerLevel, sum(statWidths(statList, statArgs or [None]*numStats))]);
 
     for i in range(nAggLevels):
         if verbose:
@@ -54,39 +64,183 @@ def aggLoadStats(loadMat, aggLevels, statList, statArgs=None, samplesPerLevel=10
         Nchoosem = int(sp.special.comb(N, m))
 
         if Nchoosem < samplesPerLevel:
-            # Iterate through all possible combinations
-            allCombs = itertools.combinations(np.arange(N), m)
+            # Iterate through all possible combinations in revolving-door order,
+            # updating the aggregate with one added and one removed user per step
             j = 0;
-            for chosen in allCombs:
-                chosen = np.array(chosen)
-                chosenLoad = loadMat.iloc[chosen, :];
-                # Compute and save all statistics
-                for k in range(numStats):
-                    statFunc = statList[k];
-                    # Get arguments for this statistic
-                    if statArgs == None:
-                        argk = None;
-                    else:
-                        argk = statArgs[k];
-                    loadStats[i, j, k] = statFunc(chosenLoad, arg=argk);
-                j = j + 1;
+            for chosen, aggregate in bls.enumerateProfiles(loads, m):
+                loadStats[i, j:j+len(chosen), :] = evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex, aggregate);
+                j = j + len(chosen);
         else:
             # Generate "samplesPerLevel" of random combinations
             for j in range(samplesPerLevel):
                 chosen = random.choice(N, size=m, replace=False);
-                chosenLoad = loadMat.iloc[chosen, :]
-                # Compute and save all statistics
-                for k in range(numStats):
-                    statFunc = statList[k];
-                    # Get arguments for this statistic
-                    if statArgs == None:
-                        argk = None;
-                    else:
-                        argk = statArgs[k];
-                    loadStats[i, j, k] = statFunc(chosenLoad, arg=argk);
+                # Compute and save all statistics from a single aggregation
+                loadStats[i, j, :] = evalStats(loadMat, loads, [chosen], statList, statArgs, timeIndex)[0];
 
     return loadStats
 
+# This function computes the same results as aggLoadStats, but evaluates the
+# samples of an aggregation level in batches of at most batchSize. Each batch
+# is aggregated with a single selection-matrix product and every registered
+# statistic is computed as a vectorized reduction over the whole batch.
+# Statistics without a registered version fall back to being called on each
+# sample separately. When both m and N-m are aggregation levels, the samples of
+# level N-m are the complements of those of level m, derived from the same product
+# by a subtraction from the all-user total (see BatchedLoadStatistics.LoadTotals).
+def aggLoadStatsBatched(loadMat, aggLevels, statList, statArgs=None, samplesPerLevel=100, verbose=False, batchSize=500):
+    [N, T] = np.shape(loadMat);
+
+    # Some checks of the validity of args
+    if max(aggLevels) > N:
+        print("Warning: The highest level of aggregation is greater than available loads.")
+    if (statArgs != None) and len(statList) != len(statArgs):
+        print("Arguments given, but number of stats and number of args unequal.")
+
+    nAggLevels = np.size(aggLevels);
+    numStats = len(statList);
+    loads = loadArray(loadMat);
+    timeIndex = bls.DatasetIndex(loadMat.columns);
+    totals = None;
+    levels = list(aggLevels);
+
+    # Set up the matrix for gathering results.
+    loadStats = np.nan*np.ones([nAggLevels, samplesPerLevel, sum(statWidths(statList, statArgs or [None]*numStats))]);
+    # Levels already sampled as the complements of another
+    done = set();
+
+    for i in range(nAggLevels):
+        if i in done:
+            continue
+        if verbose:
+            print("Agg level: " + str(i))
+        m = aggLevels[i];
+        combinations = bls.sampleCombinations(N, m, samplesPerLevel)
+        c = levels.index(N - m) if N - m in levels and 2*m < N else None
+
+        for start in range(0, len(combinations), batchSize):
+            chosen = combinations[start:start+batchSize]
+            if c is None:
+                loadStats[i, start:start+len(chosen), :] = evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex);
+            else:
+                if totals is None:
+                    totals = bls.LoadTotals(loads);
+                aggregate, complementAggregate = totals.withComplements(chosen);
+                loadStats[i, start:start+len(chosen), :] = evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex, aggregate);
+                loadStats[c, start:start+len(chosen), :] = evalStats(loadMat, loads, bls.complementCombinations(chosen, N),
+                                                                     statList, statArgs, timeIndex, complementAggregate);
+        if c is not None:
+            done.add(c)
+
+    return loadStats
+
+# This function computes the same results as aggLoadStatsBatched, but draws only as
+# many samples at each aggregation level as needed for the confidence interval of
+# the mean of every statistic (of its quantile if given, between 0 and 1) to be at
+# most targetWidth wide relative to the estimate, at the given confidence level
+# (see RunningStatistics.ConfidenceMonitor), up to maxSamplesPerLevel. Levels
+# with at most maxSamplesPerLevel combinations are enumerated as before. Samples
+# are drawn in batches of batchSize, and with antithetic in antithetic pairs (see
+# BatchedLoadStatistics.antitheticCombination), the means being estimated from
+# the pair averages. Returns the [A x maxSamplesPerLevel x W] statistics, NaN
+# past the samples drawn, and the [A] numbers of samples drawn at each level.
+def aggLoadStatsAdaptive(loadMat, aggLevels, statList, statArgs=None, targetWidth=0.01, confidence=0.95, quantile=None,
+                         maxSamplesPerLevel=1000, antithetic=False, verbose=False, batchSize=100):
+    [N, T] = np.shape(loadMat);
+
+    # Some checks of the validity of args
+    if max(aggLevels) > N:
+        print("Warning: The highest level of aggregation is greater than available loads.")
+    if (statArgs != None) and len(statList) != len(statArgs):
+        print("Arguments given, but number of stats and number of args unequal.")
+
+    nAggLevels = np.size(aggLevels);
+    numStats = len(statList);
+    loads = loadArray(loadMat);
+    timeIndex = bls.DatasetIndex(loadMat.columns);
+    width = sum(statWidths(statList, statArgs or [None]*numStats));
+
+    # Set up the matrix for gathering results.
+    loadStats = np.nan*np.ones([nAggLevels, maxSamplesPerLevel, width]);
+    samplesUsed = np.zeros(nAggLevels, dtype=int);
+
+    for i in range(nAggLevels):
+        m = aggLevels[i];
+        Nchoosem = int(sp.special.comb(N, m))
+
+        if Nchoosem <= maxSamplesPerLevel:
+            combinations = bls.sampleCombinations(N, m, maxSamplesPerLevel + 1)
+            for start in range(0, len(combinations), batchSize):
+                chosen = combinations[start:start+batchSize]
+                loadStats[i, start:start+len(chosen), :] = evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex);
+            samplesUsed[i] = len(combinations)
+        else:
+            monitors = [ConfidenceMonitor(targetWidth, confidence, quantile, population=Nchoosem, pairs=antithetic)
+                        for w in range(width)]
+            j = 0;
+            while j < maxSamplesPerLevel and not all(monitor.converged for monitor in monitors):
+                # Even batches keep the antithetic pairs within a batch
+                S = min(batchSize + batchSize % 2, maxSamplesPerLevel - j)
+                if antithetic:
+                    chosen = bls.antitheticCombinations(N, m, S)
+                else:
+                    chosen = bls.sampleCombinations(N, m, S)
+                results = evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex);
+                for row in results:
+                    loadStats[i, j, :] = row;
+                    j = j + 1;
+                    for monitor, x in zip(monitors, row):
+                        if np.isfinite(x):
+                            monitor.update(x)
+                    if all(monitor.converged for monitor in monitors):
+                        break
+            samplesUsed[i] = j
+
+        if verbose:
+            print("Agg level: " + str(i) + ", samples: " + str(samplesUsed[i]))
+
+    return loadStats, samplesUsed
+
+# Returns the load matrix as a numpy array, with missing measurements counted
+# as zero load as the pandas sums in the statistics below do. float32 loads
+# (e.g. read from a LoadCache or the Kitobo database) are kept in single precision;
+# aggregates are still summed in double precision.
+def loadArray(loadMat):
+    loads = np.asarray(loadMat);
+    loads = loads.astype(np.float32 if loads.dtype == np.float32 else float, copy=False);
+    return np.where(np.isnan(loads), loads.dtype.type(0), loads)
+
+# Computes every statistic in statList on each of the chosen combinations
+# (an [S x m] array), aggregating each combination only once. Statistics in
+# the registry (see BatchedLoadStatistics) share the aggregate and anything
+# derived from it; any other function is called on the sample's loads.
+# The [S x T] aggregate profiles of the combinations can be passed in if
+# they are already known. Returns an [S x numStats] array.
+def evalStats(loadMat, loads, chosen, statList, statArgs, timeIndex, aggregate=None):
+    chosen = np.atleast_2d(chosen);
+    [S, m] = np.shape(chosen);
+    if statArgs == None:
+        statArgs = [None]*len(statList);
+    if aggregate is None:
+        aggregate = bls.aggregateProfiles(loads, chosen);
+    data = bls.AggregateData(aggregate, m, timeIndex);
+    # All percentiles of the run are computed in a single partial sort
+    for k in range(len(statList)):
+        data.requestPercentiles(bls.requiredPercentiles(statList[k], statArgs[k]));
+
+    widths = statWidths(statList, statArgs);
+    offsets = np.concatenate([[0], np.cumsum(widths)]);
+    results = np.nan*np.ones([S, offsets[-1]]);
+    for k in range(len(statList)):
+        statFunc = statList[k];
+        argk = statArgs[k];
+        cols = slice(offsets[k], offsets[k+1]);
+        if bls.isRegistered(statFunc):
+            results[:, cols] = np.reshape(data.evaluate(statFunc, argk), [S, widths[k]]);
+        else:
+            for s in range(S):
+                results[s, cols] = statFunc(loadMat.iloc[chosen[s], :], arg=argk);
+    return results
+
 ###################################################################
 # Statistics we wish to compute on aggregate load
 # All these functions take an MxT matrix argument where
@@ -126,10 +280,8 @@ def cvLoad(load, arg=None):
 def hourlyVar(load, arg=[12]):
     hour = arg[0];
     totalLoad = np.sum(load, axis=0);
-    # Get time indices of total load
-    times = pd.DatetimeIndex(totalLoad.index)
     # Get indices of measurements at the hour of interest
-    hour_idx = (times.hour==hour);
+    hour_idx = bls.DatasetIndex(totalLoad.index).columnsAtHour(hour);
     return np.var(totalLoad.iloc[hour_idx]);
 
 # This function has the same aim as 'hourlyVar' but we normalize
@@ -137,15 +289,21 @@ def hourlyVar(load, arg=[12]):
 def hourlyCVLoad(load, arg=[12]):
     hour = arg[0];
     totalLoad = np.sum(load, axis=0);
-    # Get time indices of total load
-    times = pd.DatetimeIndex(totalLoad.index)
     # Get indices of measurements at the hour of interest
-    hour_idx = (times.hour==hour);
+    hour_idx = bls.DatasetIndex(totalLoad.index).columnsAtHour(hour);
     # Get load the hour
     hourLoad = totalLoad.iloc[hour_idx];
     hourMean = np.mean(hourLoad); hourSig = np.sqrt(np.var(hourLoad));
     return hourSig / hourMean
 
+# The variance of load at each of the given hours of the day (every hour
+# by default), one value per hour.
+def hourlyVars(load, arg=None):
+    hours = list(range(24)) if arg is None else arg;
+    totalLoad = np.sum(load, axis=0);
+    index = bls.DatasetIndex(totalLoad.index);
+    return np.array([np.var(totalLoad.iloc[index.columnsAtHour(h)]) for h in hours])
+
 # This is a generalization of the load factor which uses a percentile
 # rather than the maximum.
 def genLoadFactor(load, arg=[100]):
@@ -156,6 +314,104 @@ def genLoadFactor(load, arg=[100]):
     meanLoad = np.mean(totalLoad);
     return meanLoad / perLoad
 
+# The generalized load factor at each of several percentiles, computed from a
+# single partial sort of the total load. arg is the vector of percentiles; in
+# the output of aggLoadStats this statistic fills one column per percentile.
+def genLoadFactors(load, arg=[100]):
+    totalLoad = np.sum(load, axis=0);
+    perLoad = bls.batchPercentile(np.asarray(totalLoad, dtype=float), arg)[0];
+    meanLoad = np.mean(totalLoad);
+    return meanLoad / perLoad
+
+# The autocorrelation of the total load at each of the lags in arg (in
+# time steps). The whole autocorrelation function up to the largest lag is
+# computed at once with an FFT. In the output of aggLoadStats this statistic
+# fills one column per lag.
+def autocorrelations(load, arg=[1]):
+    totalLoad = np.sum(load, axis=0);
+    lags = np.asarray(arg, dtype=int);
+    return bls.batchACF(np.asarray(totalLoad, dtype=float), max(lags))[0, lags]
+
+# Statistics returning one value per element of their argument
+multiValuedStats = [genLoadFactors, autocorrelations, hourlyVars]
+# Number of values of the multi-valued statistics without an argument
+defaultWidths = {hourlyVars: 24}
+
+# Number of output columns of each statistic in the output of aggLoadStats
+def statWidths(statList, statArgs):
+    widths = [];
+    for k in range(len(statList)):
+        if statList[k] in multiValuedStats and statArgs[k] is None:
+            widths.append(defaultWidths.get(statList[k], 1))
+        elif statList[k] in multiValuedStats:
+            widths.append(np.size(statArgs[k]))
+        else:
+            widths.append(1)
+    return widths
+
+###################################################################
+# Registered vectorized versions of the statistics above, used by
+# aggLoadStats and aggLoadStatsBatched. Each declares the inputs it
+# needs (see BatchedLoadStatistics) and returns one value per sample.
+###################################################################
+
+@bls.registerStatistic(meanTotalLoad, needs=['aggregate'])
+def vecMeanTotalLoad(aggregate, M, arg):
+    return np.mean(aggregate, axis=1)
+
+@bls.registerStatistic(varTotalLoad, needs=['aggregate'])
+def vecVarTotalLoad(aggregate, M, arg):
+    return np.var(aggregate, axis=1)
+
+@bls.registerStatistic(meanTotalLoadPerUser, needs=['aggregate'])
+def vecMeanTotalLoadPerUser(aggregate, M, arg):
+    return np.mean(aggregate, axis=1) / float(M)
+
+@bls.registerStatistic(varTotalLoadPerUser, needs=['aggregate'])
+def vecVarTotalLoadPerUser(aggregate, M, arg):
+    return np.var(aggregate, axis=1) / float(M)**2
+
+@bls.registerStatistic(loadFactor, needs=['aggregate'])
+def vecLoadFactor(aggregate, M, arg):
+    return bls.batchLoadFactor(aggregate)
+
+@bls.registerStatistic(cvLoad, needs=['aggregate'])
+def vecCVLoad(aggregate, M, arg):
+    return bls.batchCOV(aggregate)
+
+# The hourly statistics share the per-hour moments of the batch
+@bls.registerStatistic(hourlyVar, needs=['hourMoments'])
+def vecHourlyVar(hourMoments, M, arg):
+    hour = (arg or [12])[0];
+    return hourMoments[1][:, hour]
+
+@bls.registerStatistic(hourlyCVLoad, needs=['hourMoments'])
+def vecHourlyCVLoad(hourMoments, M, arg):
+    hour = (arg or [12])[0];
+    return np.sqrt(hourMoments[1][:, hour]) / hourMoments[0][:, hour]
+
+@bls.registerStatistic(hourlyVars, needs=['hourMoments'])
+def vecHourlyVars(hourMoments, M, arg):
+    hours = list(range(24)) if arg is None else arg;
+    return hourMoments[1][:, hours]
+
+@bls.registerStatistic(genLoadFactor, needs=['aggregate', 'percentiles'],
+                       percentiles=lambda arg: (arg or [100])[:1])
+def vecGenLoadFactor(aggregate, perLoad, M, arg):
+    percentile = (arg or [100])[0];
+    return np.mean(aggregate, axis=1) / perLoad[percentile]
+
+@bls.registerStatistic(genLoadFactors, needs=['aggregate', 'percentiles'],
+                       percentiles=lambda arg: arg)
+def vecGenLoadFactors(aggregate, perLoad, M, arg):
+    meanLoad = np.mean(aggregate, axis=1);
+    return np.array([meanLoad / perLoad[p] for p in arg]).T
+
+@bls.registerStatistic(autocorrelations, needs=['aggregate'])
+def vecAutocorrelations(aggregate, M, arg):
+    lags = np.asarray([1] if arg is None else arg, dtype=int);
+    return bls.batchACF(aggregate, max(lags))[:, lags]
+
 # This function is useful for dealing with the NaN values present in the
 # output of the aggLoadStats function. This is useful for plotting the results
 # without generating errors.
@@ -0,0 +1,87 @@
+######################################################
+# This file contains an asyncio front end of KitoboDatabase,
+# so that the sampling loop can keep several requests to a
+# remote Mongo server in flight instead of waiting on each
+# round-trip in turn.
+#
+# pymongo is blocking, so every request runs in a thread pool
+# (the MongoClient is thread safe), and a semaphore bounds the
+# number of requests in flight. Awaiting a free slot is the
+# backpressure: a caller can not get more than maxInFlight
+# requests ahead of the server. Buffered writes are sent one
+# bulk_write at a time, which keeps the sample list updates in
+# order.
+
+# Imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import time
+import numpy as np
+
+from KitoboDatabase import getMetric, profileFields
+
+class AsyncKitoboDatabase:
+
+    # db is a connected KitoboDatabase, set up with setupLoadAggregationCalculations.
+    # Must be created inside the event loop that uses it
+    def __init__(self, db, maxInFlight=8):
+        self.db = db
+        self.maxInFlight = maxInFlight
+        self.executor = ThreadPoolExecutor(maxInFlight)
+        self.slots = asyncio.Semaphore(maxInFlight)
+        self.flushLock = asyncio.Lock()
+        # Flushes are scheduled here instead of blocking in saveStats and friends
+        self.db.autoFlush = False
+
+    # Stops using the thread pool and gives flushing back to the database
+    def close(self):
+        self.executor.shutdown()
+        self.db.autoFlush = True
+
+    # Runs a blocking database call in the thread pool once a slot is free
+    async def run(self, func, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    # Returns the fields of the statistics of the sample ind, and whether they were
+    # computed (True) or found stored (False), without storing them. statistics is a
+    # list of (statistic, statisticParameters) pairs and metricNames the metrics that
+    # must be stored for stored stats to be used. Raises IndexError if the users have
+    # no aggregate data, like the calculate* methods
+    async def evaluate(self, ind, statistics, metricNames, sampleIndex=-1):
+        if len(ind) in self.db.levelStats:
+            s = self.db.getStoredStats(ind, sampleIndex)
+        else:
+            s = await self.run(self.db.getStoredStats, ind, sampleIndex)
+        if s is not None:
+            try:
+                [getMetric(s, metricName) for metricName in metricNames]
+                return s, False
+            except (KeyError, IndexError):
+                pass
+
+        if self.db.serverSide and not self.db.inMemory:
+            return await self.run(self.db.getServerSideStats, ind, statistics), True
+
+        if self.db.inMemory:
+            times, totalPower = self.db.getAggregatePower(ind)
+        else:
+            times, totalPower = await self.run(self.db.getAggregatePower, ind)
+        if len(totalPower) == 0:
+            raise IndexError('No power consumption data matching indexes')
+        return profileFields(np.atleast_2d(totalPower), None, [len(ind)], statistics)[0], True
+
+    # Sends the buffered writes as one request, after any flush still in flight
+    async def flush(self):
+        async with self.flushLock:
+            statsOps, sampleOps = self.db.takeBufferedWrites()
+            if statsOps or sampleOps:
+                await self.run(self.db.writeBufferedWrites, statsOps, sampleOps)
+
+    # Flushes once the buffers hold flushSize operations or flushInterval seconds
+    # have passed, as KitoboDatabase.flushIfDue
+    async def flushIfDue(self):
+        if (len(self.db.statsBuffer) + len(self.db.sampleBuffer) >= self.db.flushSize or
+                time.time() - self.db.lastFlush >= self.db.flushInterval):
+            await self.flush()
@@ -0,0 +1,449 @@
+######################################################
+# This file contains vectorized versions of the aggregate
+# load statistics. Instead of slicing and summing the load
+# matrix once per sampled combination of users, a batch of
+# S combinations is turned into an [S x N] selection matrix
+# and all S aggregate profiles are obtained with a single
+# matrix product. Every statistic is then a reduction along
+# the time axis of the resulting [S x T] profile matrix.
+
+# Imports
+import itertools
+import numpy as np
+import numpy.random as random
+import pandas as pd
+import scipy as sp
+import scipy.fft
+import scipy.special
+
+# Returns an [S x m] integer array of combinations of m out of N users.
+# If there are fewer than samplesPerLevel possible combinations they are all
+# enumerated, otherwise samplesPerLevel random combinations are drawn.
+def sampleCombinations(N, m, samplesPerLevel, rng=random):
+    Nchoosem = int(sp.special.comb(N, m))
+    if Nchoosem < samplesPerLevel:
+        return np.array(list(itertools.combinations(np.arange(N), m)), dtype=int).reshape(-1, m)
+    return np.array([rng.choice(N, size=m, replace=False) for j in range(samplesPerLevel)], dtype=int).reshape(-1, m)
+
+# Returns the antithetic partner of a combination ind of m out of N users, sorted:
+# m users outside ind when 2m <= N, otherwise all the users outside ind and 2m-N
+# random users of ind. The two aggregates share as few users as possible, so
+# their statistics tend to be negatively correlated and the average of the pair
+# varies less than that of two independent combinations.
+def antitheticCombination(ind, N, rng=random):
+    ind = np.asarray(ind, dtype=int)
+    m = len(ind)
+    others = np.setdiff1d(np.arange(N), ind)
+    if 2*m <= N:
+        return np.sort(rng.choice(others, size=m, replace=False))
+    return np.sort(np.concatenate([others, rng.choice(ind, size=2*m-N, replace=False)]))
+
+# Returns an [S x m] integer array of S random combinations of m out of N users
+# in antithetic pairs: rows 2i and 2i+1 are a random combination and its partner.
+def antitheticCombinations(N, m, S, rng=random):
+    combinations = []
+    for j in range(S):
+        if j % 2 == 0:
+            combinations.append(np.sort(rng.choice(N, size=m, replace=False)))
+        else:
+            combinations.append(antitheticCombination(combinations[-1], N, rng))
+    return np.array(combinations, dtype=int).reshape(-1, m)
+
+# Builds the [S x N] boolean selection matrix of a batch of combinations
+# (an [S x m] array or a list of S index lists of equal length).
+def selectionMatrix(combinations, N):
+    combinations = np.asarray(combinations, dtype=int)
+    S = np.shape(combinations)[0]
+    selection = np.zeros([S, N], dtype=bool)
+    selection[np.repeat(np.arange(S), np.shape(combinations)[1]), combinations.ravel()] = True
+    return selection
+
+# Computes the [S x T] aggregate profiles of a batch of combinations with
+# one matrix product. loadMatrix is the [N x T] array of loads. If a boolean
+# [N x T] mask of valid readings is given, also returns an [S x T] boolean
+# array that is True where every user of the sample has a valid reading.
+def aggregateProfiles(loadMatrix, combinations, mask=None):
+    if mask is None:
+        return aggregateSums(loadMatrix, combinations)
+    profiles, missing = aggregateSums(loadMatrix, combinations, mask)
+    return profiles, missing == 0
+
+# As aggregateProfiles, but with a mask returns the [S x T] numbers of missing
+# readings of each sample instead of its valid time points.
+def aggregateSums(loadMatrix, combinations, mask=None):
+    loadMatrix = np.asarray(loadMatrix)
+    [N, T] = np.shape(loadMatrix)
+    # Sums are always accumulated in double precision, also for float32 loads
+    selection = selectionMatrix(combinations, N).astype(np.result_type(loadMatrix.dtype, np.float64))
+    if mask is None:
+        return selection @ loadMatrix
+    profiles = selection @ np.where(mask, loadMatrix, 0)
+    missing = selection @ (~mask).astype(selection.dtype)
+    return profiles, missing
+
+# Returns the [S x (N-m)] complements of a batch of combinations of m out of N
+# users, each sorted.
+def complementCombinations(combinations, N):
+    combinations = np.asarray(combinations, dtype=int)
+    S = np.shape(combinations)[0]
+    return np.nonzero(~selectionMatrix(combinations, N))[1].reshape(S, N - np.shape(combinations)[1])
+
+# The all-user total profile of an [N x T] loadMatrix (and, with a mask, the number
+# of missing readings at each time point), so that the aggregates of the
+# complements of a batch of combinations come from the aggregates of the batch by
+# a single subtraction. Sampling level k then also gives samples of level N-k for
+# the cost of one aggregation. The loads and mask are used as given (e.g. shared
+# or memory-mapped); only the totals are held.
+class LoadTotals:
+
+    def __init__(self, loadMatrix, mask=None):
+        self.loads = loadMatrix
+        self.mask = mask
+        self.N = np.shape(loadMatrix)[0]
+        everyone = [np.arange(self.N)]
+        if mask is None:
+            self.total = aggregateSums(loadMatrix, everyone)[0]
+        else:
+            total, missing = aggregateSums(loadMatrix, everyone, mask)
+            self.total, self.totalMissing = total[0], missing[0]
+
+    # The aggregate profiles of a batch of combinations of the same number of users,
+    # as aggregateProfiles, and those of their complements. Returns the profiles and
+    # the complement profiles, or with a mask (profiles, valid, complementProfiles,
+    # complementValid).
+    def withComplements(self, combinations):
+        if self.mask is None:
+            sums = aggregateSums(self.loads, combinations)
+            return sums, self.total - sums
+        sums, missing = aggregateSums(self.loads, combinations, self.mask)
+        return sums, missing == 0, self.total - sums, (self.totalMissing - missing) == 0
+
+# Generates all the combinations of m out of N users (as sorted tuples) in
+# revolving-door order: each combination differs from the previous one by
+# exactly one user swapped for another. Uses the recursive construction
+# R(N, m) = R(N-1, m), followed by R(N-1, m-1) reversed with user N-1 added.
+def revolvingDoorCombinations(N, m):
+    if m == 0:
+        yield ()
+    elif m == N:
+        yield tuple(range(N))
+    else:
+        yield from revolvingDoorCombinations(N-1, m)
+        for c in reversed(list(revolvingDoorCombinations(N-1, m-1))):
+            yield c + (N-1,)
+
+# Enumerates the aggregate profiles of all the combinations of m out of the
+# N users of the [N x T] loadMatrix, in revolving-door order. Consecutive
+# combinations differ by one user, so each aggregate is obtained from the
+# previous one by adding one row and subtracting another, in O(T) instead of
+# O(mT). The aggregate is recomputed from scratch every refresh steps so that
+# rounding errors do not accumulate. Yields batches of at most batchSize
+# combinations as an [S x m] array and their [S x T] aggregate profiles, and
+# with a mask, also the [S x T] boolean array of valid time points (see
+# aggregateProfiles).
+def enumerateProfiles(loadMatrix, m, mask=None, batchSize=500, refresh=1000):
+    loads = np.asarray(loadMatrix, dtype=float)
+    if mask is not None:
+        loads = np.where(mask, loads, 0)
+        missing = (~np.asarray(mask, dtype=bool)).astype(int)
+    [N, T] = np.shape(loads)
+
+    combinations, profiles, valid = [], [], []
+    for step, c in enumerate(revolvingDoorCombinations(N, m)):
+        if step % refresh == 0:
+            total = loads[list(c)].sum(axis=0)
+            if mask is not None:
+                numMissing = missing[list(c)].sum(axis=0)
+        else:
+            [added] = set(c) - previous
+            [removed] = previous - set(c)
+            total += loads[added] - loads[removed]
+            if mask is not None:
+                numMissing += missing[added] - missing[removed]
+        previous = set(c)
+
+        combinations.append(c)
+        profiles.append(total.copy())
+        if mask is not None:
+            valid.append(numMissing == 0)
+        if len(combinations) == batchSize:
+            yield enumeratedBatch(combinations, profiles, valid, m, mask)
+            combinations, profiles, valid = [], [], []
+    if combinations:
+        yield enumeratedBatch(combinations, profiles, valid, m, mask)
+
+def enumeratedBatch(combinations, profiles, valid, m, mask):
+    combinations = np.array(combinations, dtype=int).reshape(-1, m)
+    if mask is None:
+        return combinations, np.array(profiles)
+    return combinations, np.array(profiles), np.array(valid)
+
+###################################################################
+# Statistics on a batch of aggregate profiles.
+# All these functions take an [S x T] matrix of aggregate profiles
+# and an optional [S x T] boolean matrix of valid time points, and
+# return one value per profile. Invalid time points are dropped from
+# their profile, which matches the Kitobo aggregation where only the
+# timestamps with a reading from every selected user are kept.
+###################################################################
+
+# Returns the profiles with invalid entries set to NaN so that the
+# nan-aware numpy reductions skip them.
+def maskedProfiles(profiles, valid=None):
+    if valid is None or valid.all():
+        return profiles
+    return np.where(valid, profiles, np.nan)
+
+def batchCount(profiles, valid=None):
+    if valid is None:
+        return np.full(np.shape(profiles)[0], np.shape(profiles)[1])
+    return valid.sum(axis=1)
+
+def batchMean(profiles, valid=None):
+    return np.nanmean(maskedProfiles(profiles, valid), axis=1)
+
+def batchMax(profiles, valid=None):
+    return np.nanmax(maskedProfiles(profiles, valid), axis=1)
+
+def batchMin(profiles, valid=None):
+    return np.nanmin(maskedProfiles(profiles, valid), axis=1)
+
+def batchVar(profiles, valid=None):
+    return np.nanvar(maskedProfiles(profiles, valid), axis=1)
+
+def batchLoadFactor(profiles, valid=None):
+    return batchMean(profiles, valid) / batchMax(profiles, valid)
+
+# Coefficient of variation; the population standard deviation over the
+# mean, as scipy.stats.variation computes it.
+def batchCOV(profiles, valid=None):
+    return np.sqrt(batchVar(profiles, valid)) / batchMean(profiles, valid)
+
+# Linear-interpolated percentiles (numpy's default method) of each profile,
+# for every percentile in the given vector at once. A single np.partition
+# call places all the needed order statistics, so the cost is one partial
+# sort per profile regardless of the number of percentiles. Profiles with
+# invalid time points are compressed to their valid entries, one at a time.
+# Returns an [S x P] array for P percentiles.
+def batchPercentile(profiles, percentiles, valid=None):
+    profiles = np.atleast_2d(profiles)
+    percentiles = np.reshape(np.asarray(percentiles, dtype=float), -1)
+    if valid is not None and not valid.all():
+        out = np.empty([np.shape(profiles)[0], np.size(percentiles)])
+        complete = valid.all(axis=1)
+        if complete.any():
+            out[complete] = batchPercentile(profiles[complete], percentiles)
+        for s in np.flatnonzero(~complete):
+            out[s] = batchPercentile(profiles[s, valid[s]], percentiles)[0]
+        return out
+
+    T = np.shape(profiles)[1]
+    pos = percentiles / 100.0 * (T - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, T - 1)
+    frac = pos - lo
+    partitioned = np.partition(profiles, np.unique(np.concatenate([lo, hi])), axis=1)
+    return partitioned[:, lo] * (1 - frac) + partitioned[:, hi] * frac
+
+# Generalized load factor: the mean over the load at each of the given
+# percentiles. Returns an [S x P] array for P percentiles.
+def batchLoadFactorPercentile(profiles, percentiles, valid=None):
+    return batchMean(profiles, valid)[:, np.newaxis] / batchPercentile(profiles, percentiles, valid)
+
+# Pearson correlation of each profile with itself lagged by n time steps.
+# Profiles with invalid time points are compressed to their valid entries
+# before lagging, one at a time.
+def batchAutocorrelation(profiles, n, valid=None):
+    profiles = np.asarray(profiles, dtype=float)
+    R = np.empty(np.shape(profiles)[0])
+    if valid is None:
+        complete = np.ones(np.shape(profiles)[0], dtype=bool)
+    else:
+        complete = valid.all(axis=1)
+
+    if complete.any():
+        x = profiles[complete, n:]
+        y = profiles[complete, :np.shape(profiles)[1]-n]
+        x = x - np.mean(x, axis=1, keepdims=True)
+        y = y - np.mean(y, axis=1, keepdims=True)
+        R[complete] = np.sum(x*y, axis=1) / np.sqrt(np.sum(x*x, axis=1)*np.sum(y*y, axis=1))
+
+    for s in np.flatnonzero(~complete):
+        totalPower = profiles[s, valid[s]]
+        R[s] = np.corrcoef(totalPower[n:], totalPower[:len(totalPower)-n])[0, 1]
+    return R
+
+# Autocorrelation function of each profile for every lag from 0 to maxLag,
+# in O(T log T) per profile. The value at lag n is the Pearson correlation of
+# the profile with itself lagged by n time steps, exactly as computed by
+# batchAutocorrelation: the lagged cross products of all lags come from one
+# FFT, and the means and variances of the overlapping segments from prefix
+# sums. Profiles with invalid time points are compressed to their valid
+# entries, one at a time. Returns an [S x (maxLag+1)] array.
+def batchACF(profiles, maxLag, valid=None):
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    if valid is not None and not valid.all():
+        R = np.empty([np.shape(profiles)[0], maxLag+1])
+        complete = valid.all(axis=1)
+        if complete.any():
+            R[complete] = batchACF(profiles[complete], maxLag)
+        for s in np.flatnonzero(~complete):
+            R[s] = batchACF(profiles[s, valid[s]], maxLag)[0]
+        return R
+
+    [S, T] = np.shape(profiles)
+    lags = np.arange(maxLag+1)
+    # Pearson correlation is shift invariant; centering keeps the sums small
+    x = profiles - np.mean(profiles, axis=1, keepdims=True)
+
+    nfft = sp.fft.next_fast_len(2*T)
+    X = sp.fft.rfft(x, n=nfft, axis=1)
+    crossProducts = sp.fft.irfft(X*np.conj(X), n=nfft, axis=1)[:, :maxLag+1]
+
+    cumSum = np.concatenate([np.zeros([S, 1]), np.cumsum(x, axis=1)], axis=1)
+    cumSumSq = np.concatenate([np.zeros([S, 1]), np.cumsum(x*x, axis=1)], axis=1)
+    m = T - lags
+    # x[:T-n] is the head of the profile and x[n:] its tail
+    sumHead = cumSum[:, T-lags]
+    sumTail = cumSum[:, [T]] - cumSum[:, lags]
+    sumSqHead = cumSumSq[:, T-lags]
+    sumSqTail = cumSumSq[:, [T]] - cumSumSq[:, lags]
+
+    cov = crossProducts - sumHead*sumTail/m
+    varHead = sumSqHead - sumHead**2/m
+    varTail = sumSqTail - sumTail**2/m
+    return cov / np.sqrt(varHead*varTail)
+
+###################################################################
+# Statistic registry.
+# A statistic is registered under a key (a name, or the per-sample
+# function it replaces) together with the list of inputs it needs.
+# The inputs are resolved by an AggregateData object, which computes
+# each of them at most once per batch of samples, so that a run
+# computing several statistics pays for one aggregation, one sort,
+# etc. The registered function is called with the resolved inputs in
+# the declared order, followed by the number of users M in each
+# aggregate and the statistic's argument.
+#
+# Available inputs:
+#   'aggregate' : [S x T] aggregate profiles
+#   'hourIndex' : DatasetIndex of the time points (shared by the dataset)
+#   'hourMoments' : [S x 24] means and [S x 24] variances of the aggregate
+#                 at each hour of the day, from one grouped reduction
+#   'sorted'    : [S x T] aggregate profiles sorted along time
+#   'percentiles' : dict from percentile to the S values of the aggregate
+#                 at that percentile. All the percentiles requested by the
+#                 statistics of a run come from one partial sort.
+#
+# Statistics needing 'percentiles' also register a function returning the
+# list of percentiles they use for a given argument.
+###################################################################
+
+statisticRegistry = {}
+percentileRegistry = {}
+
+def registerStatistic(key, needs=['aggregate'], percentiles=None):
+    def register(func):
+        statisticRegistry[key] = (func, list(needs))
+        if percentiles is not None:
+            percentileRegistry[key] = percentiles
+        return func
+    return register
+
+def isRegistered(key):
+    return key in statisticRegistry
+
+# The percentiles a registered statistic uses with the given argument
+def requiredPercentiles(key, arg=None):
+    if key in percentileRegistry:
+        return list(np.reshape(percentileRegistry[key](arg), -1))
+    return []
+
+# Hour-of-day features of a dataset. Built once per dataset and shared by every
+# sample, so that hour-of-day selections are not recomputed per statistic. The
+# time points are also sorted by hour once, so that the per-hour moments of a
+# whole batch of profiles come from one grouped reduction (hourMoments).
+# The times are only parsed when a feature is first needed, so a dataset whose
+# time axis is not made of datetimes can still use the other statistics.
+class DatasetIndex:
+
+    def __init__(self, times):
+        self.source = times
+        self.times = None
+        self.hourGroups = None
+
+    def build(self):
+        if self.times is None:
+            self.times = pd.DatetimeIndex(self.source)
+            self.hours = np.asarray(self.times.hour)
+            self.hourColumns = [np.flatnonzero(self.hours == h) for h in range(24)]
+        return self
+
+    def columnsAtHour(self, hour):
+        return self.build().hourColumns[hour]
+
+    # The time points sorted by hour, the number of time points of each hour, and
+    # the start in that order of each hour with time points
+    def hourGrouping(self):
+        if self.hourGroups is None:
+            hours = self.build().hours
+            order = np.argsort(hours, kind='stable')
+            counts = np.bincount(hours, minlength=24)
+            starts = (np.cumsum(counts) - counts)[counts > 0]
+            self.hourGroups = (order, counts, starts)
+        return self.hourGroups
+
+    # The means and (population) variances of an [S x T] batch of profiles over the
+    # time points of each hour of the day, as two [S x 24] arrays, NaN for hours
+    # without time points. Each is a single np.add.reduceat over the profiles with
+    # their time points sorted by hour.
+    def hourMoments(self, profiles):
+        order, counts, starts = self.hourGrouping()
+        profiles = np.atleast_2d(profiles)[:, order]
+        present = counts > 0
+        means = np.full([np.shape(profiles)[0], len(counts)], np.nan)
+        variances = np.full(np.shape(means), np.nan)
+        if not present.any():
+            return means, variances
+        means[:, present] = np.add.reduceat(profiles, starts, axis=1) / counts[present]
+        hourMeans = np.repeat(means[:, present], counts[present], axis=1)
+        variances[:, present] = np.add.reduceat((profiles - hourMeans)**2, starts, axis=1) / counts[present]
+        return means, variances
+
+# The aggregate profiles of a batch of samples, and the inputs derived from
+# them that the registered statistics may need.
+class AggregateData:
+
+    def __init__(self, aggregate, numUsers, datasetIndex=None, percentiles=[]):
+        self.aggregate = np.atleast_2d(aggregate)
+        self.numUsers = numUsers
+        self.datasetIndex = datasetIndex
+        self.percentiles = list(percentiles)
+        self.derived = {}
+
+    # Adds to the percentiles to compute in the shared partial sort. Must be
+    # called before the 'percentiles' input is first resolved.
+    def requestPercentiles(self, percentiles):
+        self.percentiles.extend(percentiles)
+
+    def get(self, need):
+        if need == 'aggregate':
+            return self.aggregate
+        if need == 'hourIndex':
+            return self.datasetIndex
+        if need not in self.derived:
+            if need == 'hourMoments':
+                self.derived[need] = self.datasetIndex.hourMoments(self.aggregate)
+            elif need == 'sorted':
+                self.derived[need] = np.sort(self.aggregate, axis=1)
+            elif need == 'percentiles':
+                percentiles = sorted(set(self.percentiles))
+                values = batchPercentile(self.aggregate, percentiles)
+                self.derived[need] = {p: values[:, i] for i, p in enumerate(percentiles)}
+            else:
+                raise ValueError('Unknown statistic input: ' + str(need))
+        return self.derived[need]
+
+    def evaluate(self, key, arg=None):
+        func, needs = statisticRegistry[key]
+        return func(*[self.get(n) for n in needs], self.numUsers, arg)
@@ -0,0 +1,118 @@
+######################################################
+# This file contains the timers and counters of the sampling
+# loop, to see where the time of a generateSamples run goes:
+# Mongo round-trips, cache probes, sample list updates,
+# convergence checks or NumPy.
+#
+# Measurements are grouped by aggregation level k (set with
+# setLevel) and by phase name. Each phase records its total
+# time and number of calls; counters record round-trips, bytes
+# received and cache hits and misses. When a level is done its
+# breakdown can be appended as one JSON line to a metrics file.
+#
+# A disabled Instrumentation does nothing: phase returns a
+# shared no-op context manager and the counters return at once,
+# so the instrumented code runs at (nearly) full speed.
+
+# Imports
+from contextlib import nullcontext
+import json
+from time import perf_counter, time
+
+import bson
+
+noPhase = nullcontext()
+
+class Phase:
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.addTime(self.name, perf_counter() - self.start)
+        return False
+
+class Instrumentation:
+
+    # metricsFile, if given, is the file that the breakdown of each level is
+    # appended to as a JSON line by writeLevel
+    def __init__(self, enabled=False, metricsFile=None):
+        self.enabled = enabled
+        self.metricsFile = metricsFile
+        self.level = None
+        self.levels = {}
+
+    def setLevel(self, k):
+        self.level = k
+
+    def current(self):
+        if self.level not in self.levels:
+            self.levels[self.level] = {'phases': {}, 'counters': {}}
+        return self.levels[self.level]
+
+    # Context manager timing a phase of the current level
+    def phase(self, name):
+        if not self.enabled:
+            return noPhase
+        return Phase(self, name)
+
+    def addTime(self, name, seconds):
+        phases = self.current()['phases']
+        seconds0, calls = phases.get(name, (0.0, 0))
+        phases[name] = (seconds0 + seconds, calls + 1)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        counters = self.current()['counters']
+        counters[name] = counters.get(name, 0) + n
+
+    # Counts a round-trip to the database for the given operation, and the bytes of
+    # the documents it returned (their BSON size)
+    def roundTrip(self, operation, documents=()):
+        if not self.enabled:
+            return
+        self.count('roundTrips')
+        self.count('roundTrips.' + operation)
+        size = sum(len(bson.encode(d)) for d in documents if d is not None)
+        if size:
+            self.count('bytesReceived', size)
+
+    def cacheProbe(self, hit):
+        self.count('cacheHits' if hit else 'cacheMisses')
+
+    # The breakdown of level k (of all levels with None): the time and calls of each
+    # phase, the counters, and the cache hit ratio
+    def report(self, k=None):
+        levels = [self.levels[k]] if k is not None else list(self.levels.values())
+        phases = {}
+        counters = {}
+        for level in levels:
+            for name, (seconds, calls) in level['phases'].items():
+                seconds0, calls0 = phases.get(name, (0.0, 0))
+                phases[name] = (seconds0 + seconds, calls0 + calls)
+            for name, n in level['counters'].items():
+                counters[name] = counters.get(name, 0) + n
+        probes = counters.get('cacheHits', 0) + counters.get('cacheMisses', 0)
+        return {
+            'k': k,
+            'phases': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in phases.items()},
+            'counters': counters,
+            'cacheHitRatio': counters.get('cacheHits', 0)/probes if probes else None
+        }
+
+    # Appends the breakdown of level k to the metrics file
+    def writeLevel(self, k):
+        if not self.enabled or self.metricsFile is None or k not in self.levels:
+            return
+        with open(self.metricsFile, 'a') as f:
+            f.write(json.dumps(dict(self.report(k), time=time())) + '\n')
+
+# Shared disabled instrumentation, the default of KitoboDatabase and
+# AggregateStatisticCalculator
+disabled = Instrumentation()
@@ -0,0 +1,208 @@
+######################################################
+# This file contains the storage backends of KitoboDatabase.
+# A backend provides the database that the sample lists and
+# statistics are stored in, and reads the raw readings that
+# the statistics are computed from:
+#
+#   MongoBackend  : the Kitobo Mongo server (credentials in config.ini)
+#   MemoryBackend : an in-process Mongo stand-in (needs mongomock), that
+#                   can be populated with readings to run offline
+#   CacheBackend  : raw readings from a LoadCache directory, results in
+#                   another backend (in-process by default)
+
+# Imports
+import configparser
+from datetime import datetime, timedelta
+import numpy as np
+from pymongo.database import Database
+from pymongo import MongoClient
+
+from LoadCache import LoadCache
+from LoadStore import readLoadArrays
+
+class MongoBackend:
+
+    # Raw readings can be aggregated by the database itself, so statistics can
+    # also be computed server side
+    requiresInMemory = False
+
+    def __init__(self, configFile='config.ini'):
+        self.configFile = configFile
+
+    def connect(self):
+
+        config = configparser.ConfigParser()
+        config.read(self.configFile)
+
+        username = config['DEFAULT']['MONGO_USERNAME']
+        password = config['DEFAULT']['MONGO_PASSWORD']
+        host = config['DEFAULT']['MONGO_HOST']
+        database = config['DEFAULT']['MONGO_DATABASE_NAME']
+
+        self.client = MongoClient(host)
+        db = Database(self.client, database)
+        db.authenticate(username, password)
+        return db
+
+    def disconnect(self):
+
+        self.client.close()
+
+    # Get all the meter Ids we will be working with for this system
+    def getMonitoringDeviceIds(self, db, samplingInterval, systemId='kit1'):
+
+        cursor = db.powerSystem.aggregate([
+            {
+                '$match': {'internalId': systemId}
+            },
+            {
+                '$project': {
+                    '_id': 0,
+                    'monitoringDeviceIds': '$serviceConnections.monitoringDeviceId'
+                }
+            }
+        ])
+        return cursor.next()['monitoringDeviceIds']
+
+    # Returns the [startTime, endTime) window to analyze: the month that has the
+    # most complete data, extended to three months for daily readings
+    def getWindow(self, db, samplingInterval, monitoringDeviceIds):
+
+        cursor = db.month.aggregate([
+            {
+                '$match': {
+                    'deviceId': {'$in': monitoringDeviceIds},
+                    'tag': 'activePwr'
+                }
+            },
+            {
+                '$group': {
+                    '_id': '$time',
+                    'totalSamples': {'$sum': '$cnt'}
+                }
+            },
+
+        ])
+        sampleCounts = sorted(list(cursor), key = lambda t: t['totalSamples'])
+
+        startTime = sampleCounts[-1]['_id']
+
+        if samplingInterval == 'fiveMinutes' or samplingInterval == 'minute': #we only look at one month
+            endTime = datetime(startTime.year, startTime.month + 1, 1) if startTime.month < 12 else datetime(startTime.year + 1, 1, 1)
+        elif samplingInterval == 'day':
+            endTime = datetime(startTime.year, startTime.month + 3, 1) if startTime.month < 10 else datetime(startTime.year + 1, startTime.month - 9, 1)
+        else:
+            raise ValueError(('Sampling interval {0} not supported').format(samplingInterval))
+        return startTime, endTime
+
+    # Reads the activePwr readings of the devices over [startTime, endTime) into a
+    # dense devices x timestamps float32 matrix. Returns the matrix, a mask that is True
+    # where there is a reading, and the timestamps
+    def readLoads(self, db, samplingInterval, monitoringDeviceIds, startTime, endTime):
+
+        cursor = db[samplingInterval].find(
+            {
+                'deviceId': {'$in': monitoringDeviceIds},
+                'tag': 'activePwr',
+                'time': {
+                    '$gte': startTime,
+                    '$lt': endTime
+                }
+            },
+            {
+                '_id': 0,
+                'deviceId': 1,
+                'time': 1,
+                'avg': 1
+            }
+        )
+        # The readings are streamed into typed arrays instead of a list
+        return readLoadArrays(cursor, monitoringDeviceIds)
+
+class MemoryBackend(MongoBackend):
+
+    def __init__(self, databaseName='kitobo'):
+        try:
+            import mongomock
+        except ImportError:
+            raise ImportError('MemoryBackend requires the mongomock package')
+        self.client = mongomock.MongoClient()
+        self.db = self.client[databaseName]
+
+    def connect(self):
+        return self.db
+
+    def disconnect(self):
+        pass
+
+    # Inserts readings into the store, in the layout of the Kitobo database:
+    # a powerSystem document listing the devices, one document per reading in
+    # the collection of the sampling interval, and monthly sample counts.
+    # loads is a devices x timestamps array, times the timestamps (naive UTC
+    # datetimes) and mask, if given, marks which entries are readings
+    def populate(self, samplingInterval, monitoringDeviceIds, times, loads, mask=None, systemId='kit1'):
+        loads = np.asarray(loads, dtype=float)
+        if mask is None:
+            mask = np.ones(loads.shape, dtype=bool)
+
+        self.db.powerSystem.insert_one({
+            'internalId': systemId,
+            'serviceConnections': [{'monitoringDeviceId': d} for d in monitoringDeviceIds]
+        })
+        readings = []
+        monthCounts = {}
+        for i, d in enumerate(monitoringDeviceIds):
+            for j in np.flatnonzero(mask[i]):
+                readings.append({'deviceId': d, 'tag': 'activePwr', 'time': times[j], 'avg': float(loads[i, j])})
+                month = datetime(times[j].year, times[j].month, 1)
+                monthCounts[(d, month)] = monthCounts.get((d, month), 0) + 1
+        if readings:
+            self.db[samplingInterval].insert_many(readings)
+        self.db.month.insert_many([
+            {'deviceId': d, 'tag': 'activePwr', 'time': month, 'cnt': cnt}
+            for (d, month), cnt in monthCounts.items()
+        ])
+
+class CacheBackend:
+
+    # Only the cached matrix is available, so statistics are computed locally
+    requiresInMemory = True
+
+    def __init__(self, cacheDirectory='loadCache', entryName=None, resultsBackend=None):
+        self.cache = LoadCache(cacheDirectory)
+        self.entryName = entryName
+        self.entry = None  # The entry read by getEntry
+        self.resultsBackend = resultsBackend if resultsBackend is not None else MemoryBackend()
+
+    def connect(self):
+        return self.resultsBackend.connect()
+
+    def disconnect(self):
+        self.resultsBackend.disconnect()
+
+    # The cache entry used: entryName if given, otherwise the entry of the
+    # sampling interval with the most readings. It is read once and kept
+    def getEntry(self, samplingInterval):
+        if self.entry is None:
+            if self.entryName is None:
+                names = [n for n in self.cache.names() if n.startswith(samplingInterval + '_')]
+                if not names:
+                    raise ValueError('No cached readings for sampling interval ' + samplingInterval)
+                self.entryName = max(names, key=self.cache.numValid)
+            self.entry = self.cache.read(self.entryName)
+        return self.entry
+
+    def getMonitoringDeviceIds(self, db, samplingInterval, systemId='kit1'):
+        return self.getEntry(samplingInterval)[3]
+
+    # The window the entry was cached for, or else the span of its time axis
+    def getWindow(self, db, samplingInterval, monitoringDeviceIds):
+        loads, mask, times, deviceIds, meta = self.getEntry(samplingInterval)
+        if 'startTime' in meta:
+            return datetime.fromisoformat(meta['startTime']), datetime.fromisoformat(meta['endTime'])
+        step = times[1] - times[0] if len(times) > 1 else timedelta(0)
+        return times[0], times[-1] + step
+
+    def readLoads(self, db, samplingInterval, monitoringDeviceIds, startTime, endTime):
+        loads, mask, times, deviceIds, meta = self.getEntry(samplingInterval)
+        return loads, mask, times
@@ -1,36 +1,241 @@
-import configparser
 from datetime import datetime
 import numpy as np
 import pymongo
-from pymongo.database import Database
-from pymongo import MongoClient
+from pymongo import DeleteOne, UpdateOne
+import time
 from statistics import stdev
 from scipy import stats
 
+import BatchedLoadStatistics as bls
+import StreamingStatistics as ss
+from LoadCache import LoadCache
+from KitoboBackends import MongoBackend, CacheBackend
+import Instrumentation
+
 defaultSamplingInterval = 'fiveMinutes'
+defaultFlushSize = 1000 #Buffered writes are flushed after this many operations...
+defaultFlushInterval = 10 #...or this many seconds
 outCollectionPrefix = 'aggregateLoadStats'
 loadFactorCollectionName = 'loadFactorSamples'
 
+#Returns the key of a sample: the bitmask of its user indices, as a hex string so
+#that it fits in an indexed Mongo field whatever the number of users. The key of a
+#combination does not depend on the order of ind
+def sampleKey(ind):
+    key = 0
+    for i in ind:
+        key |= 1 << int(i)
+    return format(key, 'x')
+
+#Returns the key of the stats document of a sample: one document holds the results
+#of a set of users over a window of readings at a sampling interval
+def resultKey(samplingInterval, startTime, endTime, ind):
+    return '{}_{:%Y%m%dT%H%M}_{:%Y%m%dT%H%M}_{}'.format(samplingInterval, startTime, endTime, sampleKey(ind))
+
+#Returns the consecutive windows of the given number of calendar months, starting
+#every step months (every months months by default) from the month of startTime,
+#that start before endTime. For example every calendar month of 2017 is
+#monthlyWindows(datetime(2017,1,1), datetime(2018,1,1)), and rolling quarters
+#starting every month are monthlyWindows(startTime, endTime, months=3, step=1)
+def monthlyWindows(startTime, endTime, months=1, step=None):
+
+    def addMonths(t, n):
+        m = t.month - 1 + n
+        return datetime(t.year + m // 12, m % 12 + 1, 1)
+
+    windows = []
+    start = datetime(startTime.year, startTime.month, 1)
+    while start < endTime:
+        windows.append((start, addMonths(start, months)))
+        start = addMonths(start, step or months)
+    return windows
+
+#Returns a metric from a stats document. Metrics stored in array fields are named
+#by their dotted path, e.g. 'acf.0' for the first selected autocorrelation lag
+def getMetric(stats, metricName):
+    value = stats
+    for key in metricName.split('.'):
+        value = value[int(key)] if isinstance(value, list) else value[key]
+    return value
+
+#Computes statistics for a batch of samples of the same number of users from a
+#devices x timestamps load matrix and its validity mask. statistics is a list of
+#(statistic, statisticParameters) pairs, all computed from the same aggregate
+#profiles. Returns, for each sample, the fields to store on its stats document.
+#This does not need a database connection, so it can also run in worker processes
+#If chunkSize is given, windows longer than chunkSize timestamps are aggregated
+#chunk by chunk (see chunkedProfileFields), so that the whole [S x T] aggregate
+#profiles are never held at once.
+def statisticFields(loadMatrix, loadMask, inds, statistics, chunkSize=None):
+
+    if chunkSize is not None and np.shape(loadMatrix)[1] > chunkSize:
+        chunks = ss.profileChunks(loadMatrix, inds, loadMask, chunkSize)
+        return chunkedProfileFields(chunks, [len(ind) for ind in inds], statistics)
+    profiles, valid = bls.aggregateProfiles(loadMatrix, inds, loadMask)
+    return profileFields(profiles, valid, [len(ind) for ind in inds], statistics)
+
+#Computes statistics for a batch of [S x T] aggregate profiles (with an optional
+#[S x T] mask of valid time points) of numUsers users each, as statisticFields
+def profileFields(profiles, valid, numUsers, statistics):
+
+    fields = [{'numUsers': n} for n in numUsers]
+    for statistic, statisticParameters in statistics:
+        if statistic == 'loadFactor':
+            avg = bls.batchMean(profiles, valid)
+            maxPower = bls.batchMax(profiles, valid)
+            minPower = bls.batchMin(profiles, valid)
+            cnt = bls.batchCount(profiles, valid)
+            for i, f in enumerate(fields):
+                f['loadFactor'] = float(avg[i]/maxPower[i])
+                f['max'] = float(maxPower[i])
+                f['min'] = float(minPower[i])
+                f['avg'] = float(avg[i])
+                f['cnt'] = int(cnt[i])
+        elif statistic == 'cov':
+            values = bls.batchCOV(profiles, valid)
+            for i, f in enumerate(fields):
+                f['cov'] = float(values[i])
+        elif statistic == 'autocorrelation':
+            values = bls.batchAutocorrelation(profiles, statisticParameters[0], valid)
+            for i, f in enumerate(fields):
+                f['autocorrelation_{0}'.format(statisticParameters[0])] = float(values[i])
+        elif statistic == 'acf':
+            lags = [int(n) for n in statisticParameters[0]]
+            values = bls.batchACF(profiles, max(lags), valid)[:, lags]
+            for i, f in enumerate(fields):
+                f['acf'] = [float(r) for r in values[i]]
+                f['acfLags'] = lags
+        elif statistic == 'loadFactorPercentile':
+            percentiles = np.round(statisticParameters[0])
+            avg = bls.batchMean(profiles, valid)
+            values = avg[:, np.newaxis] / bls.batchPercentile(profiles, percentiles, valid)
+            for i, f in enumerate(fields):
+                f['avg'] = float(avg[i])
+                for j, p in enumerate(percentiles):
+                    f['loadFactor_{}'.format(p)] = float(values[i, j])
+
+    return fields
+
+#Computes the fields of profileFields from an iterable of [S x t] chunks of the
+#aggregate profiles of S samples and their masks of valid time points, in time
+#order, with the streaming statistics of StreamingStatistics. The percentiles of
+#loadFactorPercentile come from a quantile sketch, so they are approximate on long
+#windows; all other fields are exact
+def chunkedProfileFields(chunks, numUsers, statistics):
+
+    S = len(numUsers)
+    streams = []
+    for statistic, statisticParameters in statistics:
+        if statistic == 'loadFactor':
+            streams.append(ss.StreamingMoments(S))
+        elif statistic == 'cov':
+            streams.append(ss.StreamingCOV(S))
+        elif statistic == 'autocorrelation':
+            streams.append(ss.StreamingAutocorrelation(S, [statisticParameters[0]]))
+        elif statistic == 'acf':
+            streams.append(ss.StreamingAutocorrelation(S, statisticParameters[0]))
+        elif statistic == 'loadFactorPercentile':
+            streams.append(ss.StreamingLoadFactorPercentile(S, np.round(statisticParameters[0])))
+    results = ss.streamStatistics(streams, chunks)
+
+    fields = [{'numUsers': n} for n in numUsers]
+    for (statistic, statisticParameters), stream, values in zip(statistics, streams, results):
+        if statistic == 'loadFactor':
+            for i, f in enumerate(fields):
+                f['loadFactor'] = float(values['avg'][i]/values['max'][i])
+                f['max'] = float(values['max'][i])
+                f['min'] = float(values['min'][i])
+                f['avg'] = float(values['avg'][i])
+                f['cnt'] = int(values['cnt'][i])
+        elif statistic == 'cov':
+            for i, f in enumerate(fields):
+                f['cov'] = float(values[i])
+        elif statistic == 'autocorrelation':
+            for i, f in enumerate(fields):
+                f['autocorrelation_{0}'.format(statisticParameters[0])] = float(values[i, 0])
+        elif statistic == 'acf':
+            lags = [int(n) for n in statisticParameters[0]]
+            for i, f in enumerate(fields):
+                f['acf'] = [float(r) for r in values[i]]
+                f['acfLags'] = lags
+        elif statistic == 'loadFactorPercentile':
+            percentiles = np.round(statisticParameters[0])
+            avg = stream.moments.mean
+            for i, f in enumerate(fields):
+                f['avg'] = float(avg[i])
+                for j, p in enumerate(percentiles):
+                    f['loadFactor_{}'.format(p)] = float(values[i, j])
+
+    return fields
+
 class KitoboDatabase:
 
-    def appendSample(self,k,ind):
+    #The backend holds the results and reads the raw readings (see KitoboBackends);
+    #by default the Kitobo Mongo server. instrumentation, if given, times the phases of
+    #the calculations and counts their round-trips and cache probes (see Instrumentation)
+    def __init__(self,backend=None,instrumentation=None):
+        self.backend = backend if backend is not None else MongoBackend()
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation.disabled
 
-        cursor = self.db.loadAggregationSamples.find({'_id': k})
-        if cursor.count() < 1:
-            sampleList = {
-                '_id': k,
-                'ind': []
-            }
-        else:
-            sampleList = cursor.next()
+    #Adds a sample to the sample list of level k. The list is kept locally and the
+    #sample is $push'ed to Mongo on the next flush
+    def appendSample(self,k,ind):
 
-        sampleList['ind'].append(ind)
-        self.db.loadAggregationSamples.update(
+        self.instrumentation.count('appendSample')
+        sampleList = self.getSampleList(k)
+        sampleList.append(ind)
+        self.sampleKeys[k].add(sampleKey(ind))
+        self.sampleBuffer.append(UpdateOne(
             {'_id': k},
-            {'$set': {'ind': sampleList['ind']}},
+            {'$push': {'ind': ind}},
             upsert=True
+        ))
+        self.flushIfDue()
+        return sampleList
+
+    #Adds the sample and result keys to the stats documents stored before results were
+    #keyed, so that they are found by getStoredStats and updated by saveStats. Results
+    #used to be looked up by sample index, so an old collection can hold the same set of
+    #users over the same window in several documents (e.g. with sample indexes -1 and 3),
+    #which would get the same result key. Those are merged into one document: the one
+    #already keyed if any, otherwise one with a sample index >= 0. It keeps its own
+    #fields and takes those it lacks from the others, which are deleted
+    def addResultKeys(self):
+
+        deviceIndex = {d: i for i, d in enumerate(self.monitoringDeviceIds)}
+        cursor = self.db[self.outCollectionName].find(
+            {'resultKey': {'$exists': False}, 'monitoringDeviceIds': {'$exists': True}}
         )
-        return sampleList['ind']
+        documents = {}
+        for x in cursor:
+            ind = [deviceIndex[d] for d in x['monitoringDeviceIds']]
+            key = resultKey(self.samplingInterval, x['startTime'], x['endTime'], ind)
+            documents.setdefault(key, []).append((sampleKey(ind), x))
+        if not documents:
+            return
+
+        keyed = {x['resultKey']: x for x in self.db[self.outCollectionName].find(
+            {'resultKey': {'$in': list(documents)}})}
+        updates = []
+        for key, docs in documents.items():
+            docs = sorted(docs, key=lambda d: d[1].get('sampleIndex', -1) < 0)
+            if key in keyed:
+                keeper = keyed[key]
+                others = [x for k, x in docs]
+                setObj = {}
+            else:
+                keeper = docs[0][1]
+                others = [x for k, x in docs[1:]]
+                setObj = {'sampleKey': docs[0][0], 'resultKey': key}
+            for x in others:
+                for field, value in x.items():
+                    if field not in keeper and field not in setObj and field != '_id':
+                        setObj[field] = value
+                updates.append(DeleteOne({'_id': x['_id']}))
+            if setObj:
+                updates.append(UpdateOne({'_id': keeper['_id']}, {'$set': setObj}))
+        if updates:
+            self.db[self.outCollectionName].bulk_write(updates, ordered=True)
 
     #This aggregates the power consumption from the sample users (specified by ind)
     #over the window from startTime to endTime (at initial writing this is a month)
@@ -42,20 +247,40 @@ class KitoboDatabase:
         if overwrite:
             self.db[self.outCollectionName].delete({'monitoringDeviceIds': filterMonitoringDeviceIds})
 
-        cursor = self.db[self.outCollectionName].find(
-            {
+        stats = self.getStoredStats(ind, sampleIndex)
+        if stats is not None:
+            if 'loadFactor' in stats:
+                return stats
+
+        if self.inMemory:
+            time, totalPower = self.getAggregatePower(ind)
+            if len(totalPower) == 0:
+                raise IndexError('No power consumption data matching indexes')
+            stats = {
+                'numUsers': len(ind),
+                'monitoringDeviceIds': filterMonitoringDeviceIds,
+                'userIndices': ind,
                 'startTime': self.startTime,
                 'endTime': self.endTime,
+                'samplingInterval': self.samplingInterval,
                 'sampleIndex': sampleIndex,
-                'monitoringDeviceIds': filterMonitoringDeviceIds
+                'loadFactor': float(np.mean(totalPower)/np.max(totalPower)),
+                'max': float(np.max(totalPower)),
+                'min': float(np.min(totalPower)),
+                'avg': float(np.mean(totalPower)),
+                'cnt': len(totalPower)
             }
-        )
-        if cursor.count() > 0:
-            stats = cursor.next()
-            if 'loadFactor' in stats:
-                return stats
-
-        cursor = self.db[self.samplingInterval].aggregate([
+            self.saveStats(ind, sampleIndex, {
+                'numUsers': len(ind),
+                'loadFactor': stats['loadFactor'],
+                'max': stats['max'],
+                'min': stats['min'],
+                'avg': stats['avg'],
+                'cnt': stats['cnt']
+            })
+            return stats
+
+        pipeline = [
             {
                 '$match': {
                     'deviceId': {'$in': filterMonitoringDeviceIds},
@@ -107,86 +332,146 @@ class KitoboDatabase:
                     'cnt': True
                 }
             }
-        ])
+        ]
 
-        try:
-            stats = cursor.next()
-        except StopIteration:
+        #The aggregate command runs, and returns its first batch, when it is sent
+        with self.instrumentation.phase('mongoAggregate'):
+            cursor = self.db[self.samplingInterval].aggregate(pipeline)
+            stats = next(cursor, None)
+        self.instrumentation.roundTrip('aggregate', [stats])
+        if stats is None:
             raise IndexError('No power consumption data matching indexes')
 
-        self.db[self.outCollectionName].update(
-            {
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex,
-                'monitoringDeviceIds': filterMonitoringDeviceIds
-            },
-            {
-                '$set': {
-                    'numUsers': len(ind),
-                    'monitoringDeviceIds': filterMonitoringDeviceIds,
-                    'loadFactor': stats['loadFactor'],
-                    'max': stats['max'],
-                    'min': stats['min'],
-                    'avg': stats['avg'],
-                    'cnt': stats['cnt']
-                }
-            },
-            True,
-            False
-        )
+        self.saveStats(ind, sampleIndex, {
+            'numUsers': len(ind),
+            'loadFactor': stats['loadFactor'],
+            'max': stats['max'],
+            'min': stats['min'],
+            'avg': stats['avg'],
+            'cnt': stats['cnt']
+        })
         return stats
 
     def calculateAutocorrelation(self,ind,n,overwrite=False,sampleIndex=-1):
         #n is the time lag for the autocorrelation
-        filterMonitoringDeviceIds = [self.monitoringDeviceIds[i] for i in ind]
 
         #ensure that there is a stats object there. Not the most elegant; ideally both calculateAutocorrelation and calculateAggregateLoadStats (and future methods computing a statistical property) should upsert
         #self.calculateAggregateLoadStats(ind,overwrite=False)
         #if overwrite:
         #    self.db[self.outCollectionName].delete({'monitoringDeviceIds': filterMonitoringDeviceIds})
 
-        cursor = self.db[self.outCollectionName].find(
-            {
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex,
-                'monitoringDeviceIds': filterMonitoringDeviceIds
-            }
-        )
-        if cursor.count() > 0:
-            stats = cursor.next()
+        stats = self.getStoredStats(ind, sampleIndex)
+        if stats is not None:
             try:
                 R = stats[('autocorrelation_{0}').format(n)]
                 return R
             except:
                 pass
 
-        cursor = self.getAggregateLoadProfile(filterMonitoringDeviceIds)
+        if self.serverSide and not self.inMemory:
+            R = self.getServerSideStats(ind, [('autocorrelation', [n])])['autocorrelation_{0}'.format(n)]
+        else:
+            time, totalPower = self.getAggregatePower(ind)
 
-        totalPower = [x['totalPower'] for x in list(cursor)]
+            #See http://greenteapress.com/thinkdsp/html/thinkdsp006.html section 5.2 for calculation reference
+            R = np.corrcoef(totalPower[n:],totalPower[:len(totalPower)-n])[0, 1]
 
-        #See http://greenteapress.com/thinkdsp/html/thinkdsp006.html section 5.2 for calculation reference
-        R = np.corrcoef(totalPower[n:],totalPower[:len(totalPower)-n])[0, 1]
+        self.saveStats(ind, sampleIndex, {
+            ('autocorrelation_{0}'.format(n)): R,
+            'numUsers': len(ind),
+        })
+        return R
 
-        results = self.db[self.outCollectionName].update(
-            {
-                'monitoringDeviceIds': filterMonitoringDeviceIds,
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex
-            },
-            {
-                '$set': {
-                    ('autocorrelation_{0}'.format(n)): R,
-                    'numUsers': len(ind),
-                }
-            },
-            True,
-            False
-        )
+    #Computes the autocorrelation function of the aggregate profile for every lag up to
+    #max(lags) with an FFT, and stores the values at the selected lags as a single array
+    #field 'acf' (with the lags themselves in 'acfLags')
+    def calculateAutocorrelationFunction(self,ind,lags,overwrite=False,sampleIndex=-1):
+
+        lags = [int(n) for n in lags]
+
+        s = self.getStoredStats(ind, sampleIndex)
+        if s is not None:
+            if s.get('acfLags') == lags:
+                return np.array(s['acf'])
+
+        if self.serverSide and not self.inMemory:
+            R = np.array(self.getServerSideStats(ind, [('acf', [lags])])['acf'])
+        else:
+            time, totalPower = self.getAggregatePower(ind)
+            R = bls.batchACF(totalPower, max(lags))[0, lags]
+
+        self.saveStats(ind, sampleIndex, {
+            'acf': [float(r) for r in R],
+            'acfLags': lags,
+            'numUsers': len(ind),
+        })
         return R
 
+    #Computes statistics for a batch of samples of the same number of users at once
+    #from the in-memory load matrix (see loadLoadMatrix), and stores the results.
+    #statistics is a list of (statistic, statisticParameters) pairs. The aggregate
+    #profiles of the samples and their valid time points can be passed in if they
+    #are already known. Returns the fields stored for each sample
+    def calculateStatisticBatch(self,inds,statistics,sampleIndices,profiles=None,valid=None):
+
+        with self.instrumentation.phase('statistics'):
+            if profiles is None:
+                fields = statisticFields(self.loadMatrix, self.loadMask, inds, statistics, self.chunkSize)
+            else:
+                fields = profileFields(profiles, valid, [len(ind) for ind in inds], statistics)
+        for i, ind in enumerate(inds):
+            self.saveStats(ind, sampleIndices[i], fields[i])
+        return fields
+
+    #Computes statistics for a batch of samples over every window of self.windows and
+    #stores them keyed per window. The aggregate profiles of the samples are computed
+    #once over the span of all the windows and sliced per window. Returns the fields
+    #stored, as a list with, for each window, the list of fields of each sample
+    def calculateStatisticBatchWindows(self,inds,statistics,sampleIndices):
+
+        numUsers = [len(ind) for ind in inds]
+        if self.chunkSize is None:
+            with self.instrumentation.phase('aggregation'):
+                profiles, valid = bls.aggregateProfiles(self.spanLoads, inds, self.spanMask)
+        fieldsByWindow = []
+        for w in range(len(self.windows)):
+            cols = self.windowColumns(w)
+            with self.instrumentation.phase('statistics'):
+                if self.chunkSize is None:
+                    fields = profileFields(profiles[:, cols], valid[:, cols], numUsers, statistics)
+                else:
+                    fields = statisticFields(self.spanLoads[:, cols], self.spanMask[:, cols], inds, statistics, self.chunkSize)
+            for i, ind in enumerate(inds):
+                self.saveStats(ind, sampleIndices[i], fields[i], window=w)
+            fieldsByWindow.append(fields)
+        return fieldsByWindow
+
+    #Computes several statistics of the sample ind from a single aggregation of its
+    #load profile, and stores them. statistics is a list of (statistic,
+    #statisticParameters) pairs. Returns the stored fields, or the stored stats
+    #document if it already has every metric in metricNames
+    def calculateStatistics(self,ind,statistics,metricNames,sampleIndex=-1):
+
+        s = self.getStoredStats(ind, sampleIndex)
+        if s is not None:
+            try:
+                [getMetric(s, metricName) for metricName in metricNames]
+                return s
+            except (KeyError, IndexError):
+                pass
+
+        if self.serverSide and not self.inMemory:
+            setObj = self.getServerSideStats(ind, statistics)
+        else:
+            time, totalPower = self.getAggregatePower(ind)
+            if len(totalPower) == 0:
+                raise IndexError('No power consumption data matching indexes')
+
+            with self.instrumentation.phase('statistics'):
+                setObj = profileFields(np.atleast_2d(totalPower), None, [len(ind)], statistics)[0]
+        self.saveStats(ind, sampleIndex, setObj)
+        return setObj
+
     def calculateLoadFactor(self,ind):
 
         stats = self.calculateAggregateLoadStats(ind)
@@ -198,20 +483,11 @@ class KitoboDatabase:
         # percentiles is array of integers between 0 and 100
         percentiles = np.round(percentiles)
         toReturn = percentiles.astype(float)
-        filterMonitoringDeviceIds = [self.monitoringDeviceIds[i] for i in ind]
 
-        cursor = self.db[self.outCollectionName].find(
-            {
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex,
-                'monitoringDeviceIds': filterMonitoringDeviceIds
-            }
-        )
         # Check if we already have it calculated
         notPreviouslyStored = False
-        if cursor.count() > 0:
-            s = cursor.next()
+        s = self.getStoredStats(ind, sampleIndex)
+        if s is not None:
             for i, p in enumerate(percentiles):
                 try:
                     toReturn[i] = s['loadFactor_{}'.format(p)]
@@ -224,13 +500,19 @@ class KitoboDatabase:
         if not (notPreviouslyStored):
             return toReturn
 
-        # Get the aggregate load profile
-        cursor = self.getAggregateLoadProfile(filterMonitoringDeviceIds)
+        if self.serverSide and not self.inMemory:
+            setObj = self.getServerSideStats(ind, [('loadFactorPercentile', [percentiles])])
+            for i, p in enumerate(percentiles):
+                toReturn[i] = setObj['loadFactor_{}'.format(p)]
+            self.saveStats(ind, sampleIndex, setObj)
+            return toReturn
 
-        totalPower = [x['totalPower'] for x in list(cursor)]
+        # Get the aggregate load profile
+        time, totalPower = self.getAggregatePower(ind)
         meanPower = np.mean(totalPower)
 
-        lfp = np.percentile(totalPower, percentiles)
+        # All the percentiles come from a single partial sort of the profile
+        lfp = bls.batchPercentile(totalPower, percentiles)[0]
         setObj = {
             'numUsers': len(ind),
             'avg': meanPower
@@ -239,101 +521,102 @@ class KitoboDatabase:
             toReturn[i] = meanPower/lfp[i]
             setObj['loadFactor_{}'.format(p)] = toReturn[i]
 
-        self.db[self.outCollectionName].update(
-            {
-                'monitoringDeviceIds': filterMonitoringDeviceIds,
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex
-            },
-            {
-                '$set': setObj
-            },
-            True,
-            False
-        )
+        self.saveStats(ind, sampleIndex, setObj)
         return toReturn
 
     def calculateMetricStdDev(self, k, sampleIndex, metricName):
 
         if sampleIndex < 1:
             return 0
+        self.flush()
+
+        with self.instrumentation.phase('metricStdDev'):
+            cursor = self.db[self.outCollectionName].find(
+                {
+                    'startTime': self.startTime,
+                    'endTime': self.endTime,
+                    'numUsers': k,
+                    'sampleIndex': {'$lte': sampleIndex},
+                    metricName: {'$exists': True}
+                },
+                {
+                    '_id': 0,
+                    metricName.split('.')[0]: 1
+                }
+            )
+            docs = list(cursor)
+        self.instrumentation.roundTrip('find', docs)
 
-        cursor = self.db[self.outCollectionName].find(
-            {
-                'numUsers': k,
-                'sampleIndex': {'$lte': sampleIndex},
-                metricName: {'$exists': True}
-            },
-            {
-                '_id': 0,
-                metricName: 1
-            }
-        )
-
-        metric = [x[metricName] for x in list(cursor)]
+        metric = [getMetric(x, metricName) for x in docs]
         return stdev(metric)
 
     def calculateCOV(self,ind,overwrite=False,sampleIndex=-1):
         #n is the time lag for the autocorrelation
-        filterMonitoringDeviceIds = [self.monitoringDeviceIds[i] for i in ind]
 
-        cursor = self.db[self.outCollectionName].find(
-            {
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex,
-                'monitoringDeviceIds': filterMonitoringDeviceIds
-            }
-        )
-        if cursor.count() > 0:
-            s = cursor.next()
+        s = self.getStoredStats(ind, sampleIndex)
+        if s is not None:
             try:
                 return s['cov']
             except:
                 pass
 
-        cursor = self.getAggregateLoadProfile(filterMonitoringDeviceIds)
-
-        totalPower = [x['totalPower'] for x in list(cursor)]
+        if self.serverSide and not self.inMemory:
+            cov = self.getServerSideStats(ind, [('cov', [])])['cov']
+        else:
+            time, totalPower = self.getAggregatePower(ind)
 
-        cov = stats.variation(totalPower)
+            cov = stats.variation(totalPower)
 
-        results = self.db[self.outCollectionName].update(
-            {
-                'monitoringDeviceIds': filterMonitoringDeviceIds,
-                'startTime': self.startTime,
-                'endTime': self.endTime,
-                'sampleIndex': sampleIndex
-            },
-            {
-                '$set': {
-                    'cov': cov,
-                    'numUsers': len(ind),
-                }
-            },
-            True,
-            False
-        )
+        self.saveStats(ind, sampleIndex, {
+            'cov': cov,
+            'numUsers': len(ind),
+        })
         return cov
 
     def connect(self):
 
-        config = configparser.ConfigParser()
-        config.read('config.ini')
+        self.db = self.backend.connect()
 
-        username = config['DEFAULT']['MONGO_USERNAME']
-        password = config['DEFAULT']['MONGO_PASSWORD']
-        host = config['DEFAULT']['MONGO_HOST']
-        database = config['DEFAULT']['MONGO_DATABASE_NAME']
+    def disconnect(self):
 
-        self.client = MongoClient(host)
-        self.db = Database(self.client, database)
-        self.db.authenticate(username, password)
+        self.flush()
+        self.backend.disconnect()
+
+    #Writes all buffered statistics and sample list changes to Mongo, with one
+    #bulk_write per collection
+    def flush(self):
+
+        statsOps, sampleOps = self.takeBufferedWrites()
+        self.writeBufferedWrites(statsOps, sampleOps)
+
+    #Loads every stats document of level k for the current window in one query, so
+    #that getStoredStats and getStoredMetrics answer from memory for this level.
+    #Returns a dictionary from sample key to document
+    def prefetchStats(self,k):
+        self.flush()
+
+        with self.instrumentation.phase('prefetchStats'):
+            cursor = self.db[self.outCollectionName].find(
+                {
+                    'startTime': self.startTime,
+                    'endTime': self.endTime,
+                    'numUsers': k
+                },
+                {
+                    '_id': 0
+                }
+            )
+            self.levelStats[k] = {x['sampleKey']: x for x in cursor if 'sampleKey' in x}
+        self.instrumentation.roundTrip('find', self.levelStats[k].values())
+        return self.levelStats[k]
 
-    def disconnect(self):
+    #Flushes the write buffer once it holds flushSize operations or flushInterval
+    #seconds have passed since the last flush
+    def flushIfDue(self):
 
-        self.client.close()
+        if self.autoFlush and (len(self.statsBuffer) + len(self.sampleBuffer) >= self.flushSize or
+                time.time() - self.lastFlush >= self.flushInterval):
+            self.flush()
 
     def getAggregateLoadProfile(self,filterMonitoringDeviceIds):
 
@@ -366,9 +649,150 @@ class KitoboDatabase:
         ])
         return cursor
 
+    #Returns the timestamps and aggregate power of the users specified by ind, keeping
+    #only the timestamps at which every one of those users has a reading. When the load
+    #matrix has been loaded (see loadLoadMatrix) this is a local row sum, otherwise the
+    #aggregation is done by Mongo
+    def getAggregatePower(self,ind):
+
+        if self.inMemory:
+            with self.instrumentation.phase('aggregation'):
+                valid = self.loadMask[ind, :].all(axis=0)
+                totalPower = self.loadMatrix[ind, :][:, valid].sum(axis=0, dtype=float)
+            return self.loadTimes[valid], totalPower
+
+        filterMonitoringDeviceIds = [self.monitoringDeviceIds[i] for i in ind]
+        with self.instrumentation.phase('mongoAggregate'):
+            c = list(self.getAggregateLoadProfile(filterMonitoringDeviceIds))
+        self.instrumentation.roundTrip('aggregate', c)
+        return [x['_id'] for x in c], np.array([x['totalPower'] for x in c])
+
+    #Computes statistics of the aggregate profile of the users ind inside the Mongo
+    #aggregation pipeline, so that only a few scalars come back instead of the whole
+    #series. statistics is a list of (statistic, statisticParameters) pairs, and the
+    #returned fields are those of profileFields. Lagged autocorrelations come from the
+    #centered sums of lagged products, with the lagged values obtained by $shift in
+    #$setWindowFields (MongoDB 5.0+). Percentiles use $percentile (MongoDB 7.0+), which
+    #is approximate, so they can differ slightly from the client side. mongomock supports
+    #neither, so this is only checked against profileFields by benchmarkServerSideStats.py
+    #on a live mongod
+    def getServerSideStats(self,ind,statistics):
+
+        filterMonitoringDeviceIds = [self.monitoringDeviceIds[i] for i in ind]
+        lags = set()
+        percentiles = []
+        for statistic, statisticParameters in statistics:
+            if statistic == 'autocorrelation':
+                lags.add(int(statisticParameters[0]))
+            elif statistic == 'acf':
+                lags.update(int(n) for n in statisticParameters[0])
+            elif statistic == 'loadFactorPercentile':
+                percentiles.extend(np.round(statisticParameters[0]))
+        lags = sorted(lags)
+        percentiles = sorted(set(percentiles))
+
+        pipeline = [
+            {
+                '$match': {
+                    'deviceId': {'$in': filterMonitoringDeviceIds},
+                    'tag': 'activePwr',
+                    'time': {
+                        '$gte': self.startTime,
+                        '$lt': self.endTime
+                    }
+                }
+            },
+            {
+                '$group': {
+                    '_id': '$time',
+                    'totalPower': {'$sum': '$avg'},
+                    'cnt': {'$sum': 1}
+                }
+            },
+            {
+                '$match': {
+                    'cnt': len(filterMonitoringDeviceIds)
+                }
+            }
+        ]
+        group = {
+            '_id': None,
+            'cnt': {'$sum': 1},
+            'max': {'$max': '$totalPower'},
+            'min': {'$min': '$totalPower'},
+            'avg': {'$avg': '$totalPower'},
+            'std': {'$stdDevPop': '$totalPower'}
+        }
+        if lags:
+            #Every value is paired with the one n time steps before it, and both are
+            #centered on the mean of the whole profile to keep the sums small
+            output = {'mean': {'$avg': '$totalPower', 'window': {'documents': ['unbounded', 'unbounded']}}}
+            for n in lags:
+                output['lag{}'.format(n)] = {'$shift': {'output': '$totalPower', 'by': -n}}
+            pipeline.append({'$setWindowFields': {'sortBy': {'_id': 1}, 'output': output}})
+            for n in lags:
+                hasLag = {'$gt': ['$lag{}'.format(n), None]}
+                x = {'$subtract': ['$totalPower', '$mean']}
+                y = {'$subtract': ['$lag{}'.format(n), '$mean']}
+                group['lag{}_cnt'.format(n)] = {'$sum': {'$cond': [hasLag, 1, 0]}}
+                group['lag{}_x'.format(n)] = {'$sum': {'$cond': [hasLag, x, 0]}}
+                group['lag{}_y'.format(n)] = {'$sum': {'$cond': [hasLag, y, 0]}}
+                group['lag{}_xx'.format(n)] = {'$sum': {'$cond': [hasLag, {'$multiply': [x, x]}, 0]}}
+                group['lag{}_yy'.format(n)] = {'$sum': {'$cond': [hasLag, {'$multiply': [y, y]}, 0]}}
+                group['lag{}_xy'.format(n)] = {'$sum': {'$cond': [hasLag, {'$multiply': [x, y]}, 0]}}
+        if percentiles:
+            group['percentiles'] = {'$percentile': {
+                'input': '$totalPower',
+                'p': [float(p)/100 for p in percentiles],
+                'method': 'approximate'
+            }}
+        pipeline.append({'$group': group})
+
+        try:
+            with self.instrumentation.phase('mongoAggregate'):
+                r = self.db[self.samplingInterval].aggregate(pipeline).next()
+        except StopIteration:
+            raise IndexError('No power consumption data matching indexes')
+        finally:
+            self.instrumentation.roundTrip('aggregate')
+
+        #Pearson correlation of the profile with itself lagged by n, from the sums
+        def lagCorrelation(n):
+            m = r['lag{}_cnt'.format(n)]
+            sx, sy = r['lag{}_x'.format(n)], r['lag{}_y'.format(n)]
+            cov = r['lag{}_xy'.format(n)] - sx*sy/m
+            varX = r['lag{}_xx'.format(n)] - sx**2/m
+            varY = r['lag{}_yy'.format(n)] - sy**2/m
+            return float(cov/np.sqrt(varX*varY))
+
+        fields = {'numUsers': len(ind)}
+        for statistic, statisticParameters in statistics:
+            if statistic == 'loadFactor':
+                fields['loadFactor'] = float(r['avg']/r['max'])
+                fields['max'] = float(r['max'])
+                fields['min'] = float(r['min'])
+                fields['avg'] = float(r['avg'])
+                fields['cnt'] = int(r['cnt'])
+            elif statistic == 'cov':
+                fields['cov'] = float(r['std']/r['avg'])
+            elif statistic == 'autocorrelation':
+                fields['autocorrelation_{0}'.format(statisticParameters[0])] = lagCorrelation(int(statisticParameters[0]))
+            elif statistic == 'acf':
+                fields['acf'] = [lagCorrelation(int(n)) for n in statisticParameters[0]]
+                fields['acfLags'] = [int(n) for n in statisticParameters[0]]
+            elif statistic == 'loadFactorPercentile':
+                fields['avg'] = float(r['avg'])
+                for p in np.round(statisticParameters[0]):
+                    fields['loadFactor_{}'.format(p)] = float(r['avg']/r['percentiles'][percentiles.index(p)])
+        return fields
+
     def getMedianLoadProfile(self,k,metricName):
+        self.flush()
+
         cursor = self.db[self.outCollectionName].find(
             {
+                'startTime': self.startTime,
+                'endTime': self.endTime,
                 'numUsers': k,
                 'sampleIndex': {'$ne': -1}
             },
@@ -380,17 +804,19 @@ class KitoboDatabase:
         cursorList = list(cursor)
         medianInd = int(len(cursorList)/2)
 
-        cursor = self.getAggregateLoadProfile(cursorList[medianInd]['monitoringDeviceIds'])
-        c = list(cursor)
-        totalPower = [x['totalPower'] for x in c]
-        time =  [x['_id'] for x in c]
-        return time,totalPower,cursorList[medianInd][metricName]
+        ind = [self.monitoringDeviceIds.index(x) for x in cursorList[medianInd]['monitoringDeviceIds']]
+        time, totalPower = self.getAggregatePower(ind)
+        return list(time),list(totalPower),cursorList[medianInd][metricName]
 
     def getMetricSamples(self, k, metricNames, sort=0):
+        self.flush()
+
         if isinstance(metricNames, str):
             metricNames = [metricNames]
 
         where = {
+            'startTime': self.startTime,
+            'endTime': self.endTime,
             'numUsers': k,
             'sampleIndex': {'$ne': -1}
         }
@@ -398,7 +824,7 @@ class KitoboDatabase:
 
         for mN in metricNames:
             where[mN] = {'$exists': True}
-            select[mN] = True
+            select[mN.split('.')[0]] = True
 
         cursor = self.db[self.outCollectionName].find(where, select)
         if sort > 0:
@@ -408,7 +834,7 @@ class KitoboDatabase:
         if len(metricNames) > 1:
             return list(cursor)
         else:
-            return [x[metricNames[0]] for x in list(cursor)]
+            return [getMetric(x, metricNames[0]) for x in list(cursor)]
 
     def getMonitoringDeviceIds(self):
         return self.monitoringDeviceIds
@@ -418,15 +844,68 @@ class KitoboDatabase:
 
     def getSampleList(self,k):
 
-        cursor = self.db.loadAggregationSamples.find({'_id': k})
-        if cursor.count() < 1:
-            return []
+        if k not in self.sampleLists:
+            with self.instrumentation.phase('getSampleList'):
+                sampleList = self.db.loadAggregationSamples.find_one({'_id': k})
+            self.instrumentation.roundTrip('find_one', [sampleList])
+            self.sampleLists[k] = [] if sampleList is None else sampleList['ind']
+            self.sampleKeys[k] = set(sampleKey(ind) for ind in self.sampleLists[k])
+        return self.sampleLists[k]
+
+    #Returns True if the combination of users ind is in the sample list of level k,
+    #in O(1) with the set of sample keys kept alongside the list
+    def hasSample(self,k,ind):
+
+        self.getSampleList(k)
+        return sampleKey(ind) in self.sampleKeys[k]
+
+    #Returns the stats document of the set of users ind for the current window,
+    #including any buffered values not yet flushed, or None if nothing has been stored
+    #for it. Answered from memory if the level has been prefetched (see prefetchStats),
+    #otherwise with a lookup on the unique result key
+    def getStoredStats(self,ind,sampleIndex=-1):
+
+        key = sampleKey(ind)
+        if len(ind) in self.levelStats:
+            stats = self.levelStats[len(ind)].get(key)
+            self.instrumentation.cacheProbe(stats is not None)
+            return stats
+
+        with self.instrumentation.phase('cacheProbe'):
+            stats = self.db[self.outCollectionName].find_one(
+                {
+                    'resultKey': resultKey(self.samplingInterval, self.startTime, self.endTime, ind)
+                }
+            )
+        self.instrumentation.roundTrip('find_one', [stats])
+        self.instrumentation.cacheProbe(stats is not None or key in self.pendingStats)
+        pending = self.pendingStats.get(key)
+        if pending is not None:
+            stats = dict(stats or {})
+            stats.update(pending)
+        return stats
 
-        return cursor.next()['ind']
+    #Returns the metric of every sample of level k stored for the current window, as a
+    #dictionary from sample index to value, from the prefetched stats of the level
+    def getStoredMetrics(self, k, metricName):
+
+        levelStats = self.levelStats[k] if k in self.levelStats else self.prefetchStats(k)
+        stored = {}
+        for x in levelStats.values():
+            try:
+                if x.get('sampleIndex', -1) >= 0:
+                    stored[x['sampleIndex']] = getMetric(x, metricName)
+            except (KeyError, IndexError):
+                pass
+        return stored
 
     def getSampleStats(self, k):
+        self.flush()
+
         cursor = self.db[self.outCollectionName].find(
             {
+                'startTime': self.startTime,
+                'endTime': self.endTime,
                 'numUsers': k,
                 'sampleIndex': {'$ne': -1},
                 'max': {'$exists': True},
@@ -443,16 +922,175 @@ class KitoboDatabase:
         )
         return list(cursor)
 
+    #Returns True if the users specified by ind share at least one timestamp with a
+    #reading in the in-memory load matrix, in every window of self.windows
+    def hasAggregateData(self,ind):
+        valid = self.spanMask[ind, :].all(axis=0)
+        return all(bool(valid[self.windowColumns(w)].any()) for w in range(len(self.windows)))
+
+    #Pulls the activePwr readings of every monitoring device over the span of all the
+    #windows into a dense devices x timestamps matrix, with a mask marking which entries
+    #have a reading. Once loaded, all statistics are computed locally from this matrix
+    #and Mongo is only used to persist the results; the matrix of each window is a
+    #view of its columns (see selectWindow). If a load cache is set up, the matrix is
+    #memory-mapped from it when present, and written to it after fetching otherwise
+    def loadLoadMatrix(self):
+
+        spanStart = min(w[0] for w in self.windows)
+        spanEnd = max(w[1] for w in self.windows)
+        self.inMemory = True
+
+        #The readings already come from a load cache
+        if isinstance(self.backend, CacheBackend):
+            self.spanLoads, self.spanMask, self.spanTimes = self.backend.readLoads(
+                self.db, self.samplingInterval, self.monitoringDeviceIds, spanStart, spanEnd)
+            self.cache = self.backend.cache
+            self.cacheEntry = self.backend.entryName
+            self.selectWindow(self.window)
+            return
+
+        if self.cache is not None:
+            self.cacheEntry = self.cache.entryName(self.samplingInterval, spanStart, spanEnd)
+            if self.cache.contains(self.cacheEntry):
+                loads, mask, times, deviceIds, meta = self.cache.read(self.cacheEntry)
+                if deviceIds == self.monitoringDeviceIds:
+                    self.spanLoads = loads
+                    self.spanMask = mask
+                    self.spanTimes = times
+                    self.selectWindow(self.window)
+                    return
+
+        self.spanLoads, self.spanMask, self.spanTimes = self.backend.readLoads(
+            self.db, self.samplingInterval, self.monitoringDeviceIds, spanStart, spanEnd)
+        self.selectWindow(self.window)
+
+        if self.cache is not None:
+            self.cache.write(self.cacheEntry, self.spanLoads, self.spanMask, self.spanTimes, self.monitoringDeviceIds, {
+                'samplingInterval': self.samplingInterval,
+                'startTime': spanStart.isoformat(),
+                'endTime': spanEnd.isoformat()
+            })
+
     def removeSample(self,k,ind):
 
-        self.db.loadAggregationSamples.update(
+        sampleList = self.getSampleList(k)
+        while ind in sampleList:
+            sampleList.remove(ind)
+        self.sampleKeys[k].discard(sampleKey(ind))
+        self.sampleBuffer.append(UpdateOne(
             {'_id': k},
             {'$pull': {'ind': ind}}
-        )
-
-    def setupLoadAggregationCalculations(self,samplingInterval='fiveMinutes'):
+        ))
+        self.flushIfDue()
+
+    #Upserts the statistics in setObj onto the stats document of the set of users ind,
+    #found by its result key. A sample index of -1 (a sample outside the sample lists)
+    #does not replace the index of an existing document. The upsert is buffered until
+    #the next flush; until then the values are also kept in pendingStats (or in the
+    #prefetched stats of the level) so that cache probes see them. The results are
+    #those of the current window, or of window (an index in self.windows) if given;
+    #those of another window are only buffered, and are seen once it is selected
+    def saveStats(self,ind,sampleIndex,setObj,window=None):
+
+        key = sampleKey(ind)
+        setObj = dict(setObj)
+        startTime, endTime = self.windows[window] if window is not None else (self.startTime, self.endTime)
+        onInsert = {
+            'sampleKey': key,
+            'monitoringDeviceIds': [self.monitoringDeviceIds[i] for i in ind],
+            'startTime': startTime,
+            'endTime': endTime,
+            'samplingInterval': self.samplingInterval
+        }
+        if sampleIndex >= 0:
+            setObj['sampleIndex'] = sampleIndex
+        else:
+            onInsert['sampleIndex'] = sampleIndex
+
+        if window is None or window == self.window:
+            if len(ind) in self.levelStats:
+                stats = self.levelStats[len(ind)].setdefault(key, dict(onInsert))
+                stats.update(setObj)
+            else:
+                self.pendingStats.setdefault(key, {}).update(setObj)
+        self.statsBuffer.append(UpdateOne(
+            {
+                'resultKey': resultKey(self.samplingInterval, startTime, endTime, ind)
+            },
+            {
+                '$set': setObj,
+                '$setOnInsert': onInsert
+            },
+            upsert=True
+        ))
+        self.flushIfDue()
+
+    #Makes window w of self.windows the current window, that statistics are computed
+    #over and stored for. The buffered writes are flushed and the prefetched stats
+    #dropped, as they may belong to another window. With the load matrix in memory,
+    #loadMatrix, loadMask and loadTimes become views of the columns of the window
+    def selectWindow(self,w):
+
+        self.flush()
+        self.levelStats = {}
+        self.window = w
+        self.startTime, self.endTime = self.windows[w]
+        if self.inMemory:
+            cols = self.windowColumns(w)
+            self.loadMatrix = self.spanLoads[:, cols]
+            self.loadMask = self.spanMask[:, cols]
+            self.loadTimes = self.spanTimes[cols]
+
+    #The columns of window w in the in-memory load matrix of the span of all windows
+    def windowColumns(self,w):
+
+        startTime, endTime = self.windows[w]
+        return slice(int(np.searchsorted(self.spanTimes, startTime)), int(np.searchsorted(self.spanTimes, endTime)))
+
+    #Empties the write buffers and returns their operations, to be written with
+    #writeBufferedWrites. flush does both; they are separate so that the write can
+    #run elsewhere, e.g. in a worker thread (see AsyncKitoboDatabase)
+    def takeBufferedWrites(self):
+
+        statsOps, sampleOps = self.statsBuffer, self.sampleBuffer
+        self.statsBuffer = []
+        self.sampleBuffer = []
+        self.pendingStats = {}
+        self.lastFlush = time.time()
+        return statsOps, sampleOps
+
+    def writeBufferedWrites(self,statsOps,sampleOps):
+
+        with self.instrumentation.phase('write'):
+            if statsOps:
+                self.db[self.outCollectionName].bulk_write(statsOps, ordered=True)
+                self.instrumentation.roundTrip('bulk_write')
+            if sampleOps:
+                self.db.loadAggregationSamples.bulk_write(sampleOps, ordered=True)
+                self.instrumentation.roundTrip('bulk_write')
+        self.instrumentation.count('writeOps', len(statsOps) + len(sampleOps))
+
+    #With serverSide, statistics that are not computed from the in-memory load matrix
+    #are computed by the Mongo aggregation pipeline (see getServerSideStats) rather
+    #than from the aggregate series fetched by getAggregatePower
+    def setupLoadAggregationCalculations(self,samplingInterval='fiveMinutes',inMemory=False,cacheDirectory=None,
+            flushSize=defaultFlushSize,flushInterval=defaultFlushInterval,serverSide=False,chunkSize=None,windows=None):
 
         self.samplingInterval = samplingInterval
+        self.flushSize = flushSize
+        self.flushInterval = flushInterval
+        self.statsBuffer = []
+        self.sampleBuffer = []
+        self.pendingStats = {}
+        self.levelStats = {}  # Prefetched stats documents of each level
+        self.sampleLists = {}
+        self.sampleKeys = {}  # Set of the sample keys of each sample list
+        self.lastFlush = time.time()
+        self.autoFlush = True  # Flush from flushIfDue; off when the caller schedules the flushes
+        self.inMemory = False
+        self.serverSide = serverSide
+        self.chunkSize = chunkSize  # Stream in-memory statistics over chunks of this many timestamps
+        self.cache = LoadCache(cacheDirectory) if cacheDirectory is not None else None
         self.outCollectionName = outCollectionPrefix + samplingInterval.capitalize()
 
         #Build indexes
@@ -463,50 +1101,28 @@ class KitoboDatabase:
             ('sampleIndex', pymongo.ASCENDING),
         ]
         self.db[self.outCollectionName].create_index(ind,unique=True)
+        #A sample index is stored once per window, so this index is not unique
         ind = [
             ('numUsers', pymongo.ASCENDING),
             ('sampleIndex', pymongo.ASCENDING)
         ]
-        self.db[self.outCollectionName].create_index(ind,unique=True)
-
-        # Get all the meter Ids we will be working with for this system
-        cursor = self.db.powerSystem.aggregate([
-            {
-                '$match': {'internalId': 'kit1'}
-            },
-            {
-                '$project': {
-                    '_id': 0,
-                    'monitoringDeviceIds': '$serviceConnections.monitoringDeviceId'
-                }
-            }
-        ])
-
-        self.monitoringDeviceIds = cursor.next()['monitoringDeviceIds']
-
-        #Find the month that has the most complete data
-        cursor = self.db.month.aggregate([
-            {
-                '$match': {
-                    'deviceId': {'$in': self.monitoringDeviceIds},
-                    'tag': 'activePwr'
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$time',
-                    'totalSamples': {'$sum': '$cnt'}
-                }
-            },
-
-        ])
-        sampleCounts = sorted(list(cursor), key = lambda t: t['totalSamples'])
-
-        self.startTime = sampleCounts[-1]['_id']
-
-        if self.samplingInterval == 'fiveMinutes' or self.samplingInterval == 'minute': #we only look at one month
-            self.endTime = datetime(self.startTime.year, self.startTime.month + 1, 1) if self.startTime.month < 12 else datetime(self.startTime.year + 1, 1, 1)
-        elif self.samplingInterval == 'day':
-            self.endTime = datetime(self.startTime.year, self.startTime.month + 3, 1) if self.startTime.month < 10 else datetime(self.startTime.year + 1, self.startTime.month - 9)
-        else:
-            error(('Sampling interval {0} not supported').format(self.samplingInterval))
+        indexes = self.db[self.outCollectionName].index_information()
+        if indexes.get('numUsers_1_sampleIndex_1', {}).get('unique'):
+            self.db[self.outCollectionName].drop_index('numUsers_1_sampleIndex_1')
+        self.db[self.outCollectionName].create_index(ind)
+        self.db[self.outCollectionName].create_index('resultKey',unique=True,sparse=True)
+
+        self.monitoringDeviceIds = self.backend.getMonitoringDeviceIds(self.db, self.samplingInterval)
+        #The windows analyzed, as (startTime, endTime) pairs (see monthlyWindows); by
+        #default the single window chosen by the backend. Statistics are computed over
+        #and stored for the current one, windows[0] until another is selected
+        if windows is None:
+            windows = [self.backend.getWindow(self.db, self.samplingInterval, self.monitoringDeviceIds)]
+        self.windows = [tuple(w) for w in windows]
+        self.window = 0
+        self.startTime, self.endTime = self.windows[0]
+        self.addResultKeys()
+
+        #Several windows are read once, over their span
+        if inMemory or self.backend.requiresInMemory or len(self.windows) > 1:
+            self.loadLoadMatrix()
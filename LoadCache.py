@@ -0,0 +1,104 @@
+######################################################
+# This file contains a local on-disk cache of raw load
+# readings, so that the Kitobo and Pecan Street analyses do
+# not have to refetch them from their database in every
+# session.
+#
+# Each cache entry is a directory holding:
+#   loads.npy : [N x T] float32 loads, one row per device
+#   mask.npy  : [N x T] bool, True where there is a reading
+#   times.npy : [T] datetime64[ms] time axis shared by all devices
+#   meta.json : device ids, number of readings and any extra metadata
+# The arrays are opened memory-mapped, so opening an entry is
+# instant and only the parts of the data that are used are read
+# from disk.
+
+# Imports
+from datetime import datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class LoadCache:
+
+    def __init__(self, directory='loadCache'):
+        self.directory = directory
+
+    def contains(self, name):
+        return os.path.exists(os.path.join(self.path(name), 'meta.json'))
+
+    # Returns the name of the cache entry of a window of readings at a
+    # sampling interval, e.g. minute_20170301_20170401
+    def entryName(self, samplingInterval, startTime, endTime):
+        return '{}_{:%Y%m%d}_{:%Y%m%d}'.format(samplingInterval, startTime, endTime)
+
+    # Names of all the entries in the cache
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(n for n in os.listdir(self.directory) if self.contains(n))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # The metadata dictionary of an entry
+    def meta(self, name):
+        with open(os.path.join(self.path(name), 'meta.json')) as f:
+            return json.load(f)
+
+    # The number of readings of an entry, counted from the mask for entries
+    # written before it was stored in the metadata
+    def numValid(self, name):
+        meta = self.meta(name)
+        if 'numValid' in meta:
+            return meta['numValid']
+        return int(np.count_nonzero(np.load(os.path.join(self.path(name), 'mask.npy'), mmap_mode='r')))
+
+    # Opens an entry. Returns the memory-mapped loads and mask, the time axis
+    # (as datetime objects), the device ids and the metadata dictionary.
+    def read(self, name):
+        path = self.path(name)
+        meta = self.meta(name)
+        loads = np.load(os.path.join(path, 'loads.npy'), mmap_mode='r')
+        mask = np.load(os.path.join(path, 'mask.npy'), mmap_mode='r')
+        times = np.load(os.path.join(path, 'times.npy')).astype(datetime)
+        return loads, mask, times, meta['deviceIds'], meta
+
+    # Opens an entry written by writeFrame as a [T x N] DataFrame backed by the
+    # memory-mapped loads, with NaN where there is no reading.
+    def readFrame(self, name):
+        loads, mask, times, deviceIds, meta = self.read(name)
+        if not mask.all():
+            loads = np.where(mask, loads, np.nan)
+        index = pd.DatetimeIndex(times)
+        # Timestamps are stored as naive UTC
+        if meta.get('tz') is not None:
+            index = index.tz_localize('UTC').tz_convert(meta['tz'])
+        return pd.DataFrame(loads.T, index=index, columns=deviceIds, copy=False)
+
+    # Writes an entry. loads and mask are [N x T] arrays, times the T timestamps
+    # and deviceIds the N device ids. Any extra metadata must be JSON serializable.
+    def write(self, name, loads, mask, times, deviceIds, metadata={}):
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'loads.npy'), np.asarray(loads, dtype=np.float32))
+        np.save(os.path.join(path, 'mask.npy'), np.asarray(mask, dtype=bool))
+        np.save(os.path.join(path, 'times.npy'), np.asarray(times, dtype='datetime64[ms]'))
+        meta = dict(metadata)
+        meta['deviceIds'] = list(deviceIds)
+        meta['shape'] = list(np.shape(loads))
+        meta['numValid'] = int(np.count_nonzero(mask))
+        # The metadata is written last, so an interrupted write is not seen as an entry
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    # Writes a [T x N] DataFrame of loads with a DatetimeIndex (as returned by
+    # getNLoads) as an entry; NaN loads are marked missing in the mask.
+    def writeFrame(self, name, df):
+        loads = np.asarray(df, dtype=float).T
+        times = pd.DatetimeIndex(df.index)
+        tz = None if times.tz is None else str(times.tz)
+        self.write(name, np.where(np.isnan(loads), 0, loads), ~np.isnan(loads),
+                   times.tz_localize(None) if tz is None else times.tz_convert(None),
+                   [c.item() if isinstance(c, np.generic) else c for c in df.columns], {'tz': tz})
@@ -0,0 +1,46 @@
+######################################################
+# This file reads the raw load readings of many devices
+# straight into typed arrays, for windows that are too long to
+# hold as lists of documents:
+#
+#   loads : [N x T] contiguous float32 array, 0 where there is
+#           no reading
+#   mask  : [N x T] boolean array, True where there is a reading
+#   times : [T] timestamps, as naive UTC datetimes
+#
+# The readings are consumed one at a time, 20 bytes each in the
+# typed arrays, against a few hundred for a reading held as a
+# Python dict. Statistics that are streamed over chunks of time
+# use StreamingStatistics.
+
+# Imports
+from array import array
+from datetime import datetime, timedelta
+import numpy as np
+
+epoch = datetime(1970, 1, 1)
+millisecond = timedelta(milliseconds=1)
+
+# Epoch milliseconds of a naive UTC datetime
+def epochMilliseconds(t):
+    return (t - epoch) // millisecond
+
+# Reads an iterable of readings with deviceId, time (naive UTC datetime) and avg
+# fields, such as a cursor over the readings of the Kitobo database, into the
+# loads, mask and times of the deviceIds, ordered by time
+def readLoadArrays(readings, deviceIds):
+    deviceIndex = {d: i for i, d in enumerate(deviceIds)}
+    rows, times, values = array('q'), array('q'), array('f')
+    for x in readings:
+        rows.append(deviceIndex[x['deviceId']])
+        times.append(epochMilliseconds(x['time']))
+        values.append(x['avg'])
+    rows = np.frombuffer(rows, dtype=np.int64) if rows else np.zeros(0, dtype=np.int64)
+    times = np.frombuffer(times, dtype=np.int64) if times else np.zeros(0, dtype=np.int64)
+
+    timeAxis, cols = np.unique(times, return_inverse=True)
+    loads = np.zeros((len(deviceIds), len(timeAxis)), dtype=np.float32)
+    mask = np.zeros(loads.shape, dtype=bool)
+    loads[rows, cols] = np.frombuffer(values, dtype=np.float32) if values else 0
+    mask[rows, cols] = True
+    return loads, mask, timeAxis.astype('datetime64[ms]').astype(datetime)
@@ -0,0 +1,121 @@
+######################################################
+# This file contains a loader of household loads from the
+# Pecan Street database. It replaces the getNLoads helper
+# of the Pecan Street notebook, which fetched the homes one
+# after another on a new connection each and grew its result
+# with repeated pd.concat.
+#
+# Homes are fetched concurrently by a thread pool. Each
+# thread checks a connection out of the engine's pool, so the
+# pool size of the engine bounds the number of queries in
+# flight. Every fetched home is written to a LoadCache entry
+# of its own (homes that fail the quality filter too), so an
+# interrupted load resumes without refetching anything, and
+# the loads of the kept homes are copied into a preallocated
+# [N x T] array.
+#
+# The query of one home is pluggable: pecanpyFetcher queries
+# the Pecan Street schema through pecanpy, and sqlFetcher a
+# plain table of readings, e.g. in a local SQLite stand-in.
+
+# Imports
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Returns a fetcher reading the 'use' column of one home through pecanpy, as
+# getNLoads did
+def pecanpyFetcher(schema='university', columns='all'):
+    import pecanpy
+
+    def fetch(con, home, startTime, endTime, rez):
+        homeload = pecanpy.read_electricity_egauge_query(con, schema, home, startTime, endTime, columns, rez)
+        return homeload['use']
+    return fetch
+
+# Returns a fetcher reading one home from a table with a row per reading,
+# (homeColumn, timeColumn, loadColumn). The readings are taken as they are
+# stored, so rez is ignored.
+def sqlFetcher(table, homeColumn='dataid', timeColumn='localminute', loadColumn='use'):
+    from sqlalchemy import text
+    query = text('SELECT {t}, {l} FROM {table} WHERE {h} = :home AND {t} >= :startTime AND {t} < :endTime '
+                 'ORDER BY {t}'.format(t=timeColumn, l=loadColumn, h=homeColumn, table=table))
+
+    def fetch(con, home, startTime, endTime, rez):
+        params = {'home': home, 'startTime': startTime, 'endTime': endTime}
+        # Plain driver values, so that any DB-API driver can bind them
+        params = {k: v.item() if isinstance(v, np.generic) else v for k, v in params.items()}
+        df = pd.read_sql(query, con, params=params)
+        return pd.Series(df[loadColumn].values, index=pd.to_datetime(df[timeColumn].values, utc=True),
+                         name=loadColumn, dtype=float)
+    return fetch
+
+# Vectorized quality filter of the [K x T] loads of K homes, filled in from
+# series of the given lengths: a home is kept if it has readings and none of
+# them is missing.
+def goodHomes(loads, lengths):
+    return (np.asarray(lengths) > 0) & ~np.isnan(loads).any(axis=1)
+
+class PecanStreetLoader:
+
+    # engine : SQLAlchemy engine of the database
+    # fetch  : function(con, home, startTime, endTime, rez) returning the load
+    #          series of one home (see pecanpyFetcher and sqlFetcher)
+    # cache  : LoadCache the fetched homes are kept in, None to not cache them
+    def __init__(self, engine, fetch=None, cache=None, maxWorkers=5):
+        self.engine = engine
+        self.fetch = fetch or pecanpyFetcher()
+        self.cache = cache
+        self.maxWorkers = maxWorkers
+
+    # Name of the cache entry of one home's loads over a window
+    def entryName(self, home, startTime, endTime, rez):
+        return 'PecanSt_{}_{:%Y%m%d}_{:%Y%m%d}_{}'.format(rez, startTime, endTime, home)
+
+    # The load series of one home, from the cache if it is there
+    def loadHome(self, home, startTime, endTime, rez):
+        name = self.entryName(home, startTime, endTime, rez)
+        if self.cache is not None and self.cache.contains(name):
+            return self.cache.readFrame(name).iloc[:, 0]
+        with self.engine.connect() as con:
+            load = self.fetch(con, home, startTime, endTime, rez)
+        if self.cache is not None:
+            self.cache.writeFrame(name, pd.DataFrame({home: load}))
+        return load
+
+    # Returns the loads of the first N homes in homes that pass the quality
+    # filter, as a [T x N] DataFrame with a column per home (fewer if there
+    # are not enough good homes). The time axis is that of the first good home;
+    # a home missing readings on it fails the quality filter.
+    def getNLoads(self, N, homes, startTime, endTime, rez='H'):
+        homes = list(homes)
+        kept = []
+        times = None
+        loads = None
+        idx = 0
+        with ThreadPoolExecutor(self.maxWorkers) as executor:
+            # Fetch as many homes as are still needed at a time (at least one
+            # per worker), so that few homes past the N-th good one are fetched
+            while len(kept) < N and idx < len(homes):
+                batch = homes[idx:idx+max(N-len(kept), self.maxWorkers)]
+                idx += len(batch)
+                series = list(executor.map(lambda h: self.loadHome(h, startTime, endTime, rez), batch))
+                if times is None:
+                    first = next((s for s in series if len(s) > 0 and not s.isnull().any()), None)
+                    if first is None:
+                        continue
+                    times = first.index
+                    loads = np.empty([N, len(times)])
+                block = np.full([len(batch), len(times)], np.nan)
+                for k, s in enumerate(series):
+                    if s.index.equals(times):
+                        block[k] = s.values
+                    elif len(s) > 0:
+                        block[k] = s.reindex(times).values
+                good = np.flatnonzero(goodHomes(block, [len(s) for s in series]))[:N-len(kept)]
+                loads[len(kept):len(kept)+len(good)] = block[good]
+                kept.extend(batch[k] for k in good)
+
+        if times is None:
+            return pd.DataFrame()
+        return pd.DataFrame(loads[:len(kept)].T, index=times, columns=kept)
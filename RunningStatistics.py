@@ -0,0 +1,203 @@
+######################################################
+# This file contains online estimators used to check the
+# convergence of the sampled statistics in O(1) per sample,
+# instead of re-reading every stored sample of a level, and
+# the stopping rules of the sampling loops built on them.
+
+# Imports
+import bisect
+from statistics import NormalDist
+import numpy as np
+
+# Running count, mean and variance of a stream of values (Welford's algorithm).
+# Two estimators of disjoint streams can be merged (Chan et al.).
+class RunningStats:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+
+    @classmethod
+    def fromSamples(cls, values):
+        stats = cls()
+        for x in values:
+            stats.update(x)
+        return stats
+
+    def update(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.M2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.M2 += other.M2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+    # Sample variance (n-1 denominator, as statistics.variance); 0 for fewer
+    # than two values
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.M2 / (self.count - 1)
+
+    def stdev(self):
+        return np.sqrt(self.variance())
+
+# Running estimate of a quantile of a stream of values in O(1) memory, with
+# the P-squared algorithm of Jain and Chlamtac (1985). q is between 0 and 1.
+class RunningQuantile:
+
+    def __init__(self, q):
+        self.q = q
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2*q, 1 + 4*q, 3 + 2*q, 5]
+        self.increments = [0, q/2, q, (1 + q)/2, 1]
+
+    def update(self, x):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if h[i] <= x < h[i+1])
+
+        for i in range(k+1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Adjust the heights of the three middle markers
+        for i in range(1, 4):
+            n = self.positions
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise-parabolic prediction, or linear if it is not monotone
+                hp = h[i] + d/(n[i+1] - n[i-1]) * (
+                    (n[i] - n[i-1] + d)*(h[i+1] - h[i])/(n[i+1] - n[i]) +
+                    (n[i+1] - n[i] - d)*(h[i] - h[i-1])/(n[i] - n[i-1]))
+                if not (h[i-1] < hp < h[i+1]):
+                    hp = h[i] + d*(h[i+d] - h[i])/(n[i+d] - n[i])
+                h[i] = hp
+                n[i] += d
+
+    def value(self):
+        if len(self.heights) == 0:
+            return np.nan
+        if len(self.heights) < 5:
+            return float(np.percentile(self.heights, 100*self.q))
+        return self.heights[2]
+
+# Convergence check of generateSamples, fed one sample at a time: sampling of a
+# level stops once the relative change of the standard deviation of the metric
+# has been below tol for two consecutive samples. Optionally also tracks running
+# estimates of some quantiles of the metric.
+class ConvergenceMonitor:
+
+    def __init__(self, tol, quantiles=[]):
+        self.tol = tol
+        self.stats = RunningStats()
+        self.quantiles = [RunningQuantile(q) for q in quantiles]
+        self.prevStdDev = 0
+        self.prevT = tol
+        self.converged = False
+
+    # Adds the metric of the next sample; returns True once converged
+    def update(self, x):
+        self.stats.update(x)
+        for q in self.quantiles:
+            q.update(x)
+        newStdDev = self.stats.stdev()
+
+        if self.prevStdDev > 0:
+            t = abs(newStdDev-self.prevStdDev)/self.prevStdDev
+            if t < self.tol and self.prevT < self.tol:
+                self.converged = True
+            self.prevT = t
+
+        self.prevStdDev = newStdDev
+        return self.converged
+
+# Stopping rule targeting the precision of the estimate of a metric at a level:
+# sampling stops once the confidence interval of the mean of the metric (or of a
+# quantile of it, with quantile between 0 and 1) has a half-width of at most
+# targetWidth, relative to the estimate unless relative is False. The interval of
+# the mean comes from the central limit theorem, with the finite population
+# correction when the number of possible samples (population) is given; that of a
+# quantile from the order statistics around its rank. With pairs, consecutive
+# samples are antithetic pairs, and the mean is estimated from the pair averages.
+# Has the interface of ConvergenceMonitor; stats counts every sample fed.
+class ConfidenceMonitor:
+
+    def __init__(self, targetWidth, confidence=0.95, quantile=None, population=None, pairs=False,
+                 relative=True, minSamples=10):
+        self.targetWidth = targetWidth
+        self.z = NormalDist().inv_cdf(0.5 + confidence/2)
+        self.quantile = quantile
+        self.population = population
+        self.pairs = pairs and quantile is None
+        self.relative = relative
+        self.minSamples = minSamples
+        self.stats = RunningStats()
+        self.observations = RunningStats()  # The pair averages with pairs, else the samples
+        self.values = []  # Sorted samples, for the interval of a quantile
+        self.pending = None  # First sample of an incomplete pair
+        self.converged = False
+
+    def update(self, x):
+        self.stats.update(x)
+        if self.quantile is not None:
+            bisect.insort(self.values, x)
+        elif not self.pairs:
+            self.observations.update(x)
+        elif self.pending is None:
+            self.pending = x
+            return self.converged
+        else:
+            self.observations.update((self.pending + x)/2)
+            self.pending = None
+
+        n = self.stats.count
+        if self.population is not None and n >= self.population:
+            self.converged = True
+        elif n >= self.minSamples:
+            scale = abs(self.estimate()) if self.relative else 1
+            self.converged = self.halfWidth() <= self.targetWidth*scale
+        return self.converged
+
+    def estimate(self):
+        if self.quantile is not None:
+            return float(np.percentile(self.values, 100*self.quantile))
+        return self.observations.mean
+
+    def halfWidth(self):
+        n = self.stats.count
+        if self.quantile is not None:
+            q = self.quantile
+            spread = self.z*np.sqrt(n*q*(1 - q))
+            lo = max(int(np.floor(n*q - spread)), 0)
+            hi = min(int(np.ceil(n*q + spread)), n - 1)
+            return (self.values[hi] - self.values[lo])/2
+        m = self.observations.count
+        if m < 2:
+            return np.inf
+        halfWidth = self.z*self.observations.stdev()/np.sqrt(m)
+        if self.population is not None and self.population > 1:
+            halfWidth *= np.sqrt(max(self.population - n, 0)/(self.population - 1))
+        return halfWidth
@@ -0,0 +1,267 @@
+######################################################
+# This file contains streaming versions of the aggregate load
+# statistics, for windows too long to aggregate at once. Each
+# statistic keeps a partial aggregate of a batch of S profiles
+# that is built chunk by chunk along time:
+#
+#   stat = StreamingX(S, ...)          # init
+#   stat.update(profiles, valid)       # one [S x t] chunk
+#   stat.merge(other)                  # other covers the time
+#                                      # points after stat's
+#   stat.finalize()                    # one value per profile
+#
+# Chunks (and merged partial aggregates) must come in time
+# order. Partial aggregates of consecutive shards, e.g. months
+# computed in parallel, can be merged into that of the whole
+# window. Invalid time points are dropped from their profile,
+# as in BatchedLoadStatistics.
+#
+# Counts, extrema, means and second moments, and the sums of
+# lagged products of the autocorrelations, are exact. The
+# percentiles come from a KLL sketch, with a rank error of the
+# order of 1/k of the number of time points.
+
+# Imports
+import numpy as np
+
+import BatchedLoadStatistics as bls
+
+# Count, mean, sum of squared deviations, minimum and maximum of each profile,
+# merged with the pairwise update of Chan et al.
+class StreamingMoments:
+
+    def __init__(self, S):
+        self.count = np.zeros(S, dtype=int)
+        self.mean = np.zeros(S)
+        self.M2 = np.zeros(S)
+        self.max = np.full(S, -np.inf)
+        self.min = np.full(S, np.inf)
+
+    @classmethod
+    def fromChunk(cls, profiles, valid=None):
+        profiles = np.asarray(profiles, dtype=float)
+        if valid is None:
+            valid = np.ones(np.shape(profiles), dtype=bool)
+        stats = cls(np.shape(profiles)[0])
+        stats.count = valid.sum(axis=1)
+        stats.mean = np.where(valid, profiles, 0).sum(axis=1) / np.maximum(stats.count, 1)
+        stats.M2 = (np.where(valid, profiles - stats.mean[:, np.newaxis], 0)**2).sum(axis=1)
+        stats.max = np.where(valid, profiles, -np.inf).max(axis=1, initial=-np.inf)
+        stats.min = np.where(valid, profiles, np.inf).min(axis=1, initial=np.inf)
+        return stats
+
+    def update(self, profiles, valid=None):
+        self.merge(StreamingMoments.fromChunk(profiles, valid))
+
+    def merge(self, other):
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        weight = other.count / np.maximum(count, 1)
+        self.M2 = self.M2 + other.M2 + delta**2 * self.count * weight
+        self.mean = self.mean + delta * weight
+        self.count = count
+        self.max = np.maximum(self.max, other.max)
+        self.min = np.minimum(self.min, other.min)
+
+    # Population variance, as np.var
+    def variance(self):
+        return self.M2 / self.count
+
+    def finalize(self):
+        return {'cnt': self.count, 'avg': self.mean, 'var': self.variance(), 'max': self.max, 'min': self.min}
+
+# Load factor (mean over maximum) of each profile
+class StreamingLoadFactor(StreamingMoments):
+
+    def finalize(self):
+        return self.mean / self.max
+
+# Coefficient of variation (population standard deviation over the mean)
+class StreamingCOV(StreamingMoments):
+
+    def finalize(self):
+        return np.sqrt(self.variance()) / self.mean
+
+# Sums over the pairs (z[i], z[i+n]) of a series z, for each lag n of lags, of
+# the pairs whose first element is before firstEnd and second element at or after
+# secondStart. Returns the number of pairs and the sums of a, b, a*a, b*b and a*b,
+# with a the first and b the second element, as a [6 x L] array.
+def lagPairSums(z, lags, firstEnd, secondStart):
+    sums = np.zeros([6, len(lags)])
+    for j, n in enumerate(lags):
+        lo = max(0, secondStart - n)
+        hi = min(len(z) - n, firstEnd)
+        if hi <= lo:
+            continue
+        a = z[lo:hi]
+        b = z[lo+n:hi+n]
+        sums[:, j] = [hi - lo, a.sum(), b.sum(), a @ a, b @ b, a @ b]
+    return sums
+
+# Autocorrelations of each profile at the given lags: the Pearson correlation of
+# the profile with itself lagged by n time points, as batchAutocorrelation and
+# batchACF compute it. The sums over the lagged pairs are accumulated per chunk;
+# the first and last max(lags) values of each profile are kept so that the pairs
+# straddling two chunks (or two merged shards) are added when they are joined.
+class StreamingAutocorrelation:
+
+    def __init__(self, S, lags):
+        self.lags = [int(n) for n in lags]
+        self.maxLag = max(self.lags)
+        self.sums = np.zeros([S, 6, len(self.lags)])
+        self.heads = [np.zeros(0) for s in range(S)]
+        self.tails = [np.zeros(0) for s in range(S)]
+
+    @classmethod
+    def fromChunk(cls, profiles, lags, valid=None):
+        profiles = np.asarray(profiles, dtype=float)
+        stats = cls(np.shape(profiles)[0], lags)
+        for s in range(np.shape(profiles)[0]):
+            z = profiles[s] if valid is None else profiles[s, valid[s]]
+            stats.sums[s] = lagPairSums(z, stats.lags, len(z), 0)
+            stats.heads[s] = z[:stats.maxLag].copy()
+            stats.tails[s] = z[max(len(z) - stats.maxLag, 0):].copy()
+        return stats
+
+    def update(self, profiles, valid=None):
+        self.merge(StreamingAutocorrelation.fromChunk(profiles, self.lags, valid))
+
+    def merge(self, other):
+        L = self.maxLag
+        for s in range(len(self.heads)):
+            z = np.concatenate([self.tails[s], other.heads[s]])
+            self.sums[s] += other.sums[s] + lagPairSums(z, self.lags, len(self.tails[s]), len(self.tails[s]))
+            self.heads[s] = np.concatenate([self.heads[s], other.heads[s]])[:L]
+            tail = np.concatenate([self.tails[s], other.tails[s]])
+            self.tails[s] = tail[max(len(tail) - L, 0):]
+
+    # Returns an [S x L] array for the L lags
+    def finalize(self):
+        m, sumA, sumB, sumAA, sumBB, sumAB = np.moveaxis(self.sums, 1, 0)
+        cov = sumAB - sumA*sumB/m
+        varA = sumAA - sumA**2/m
+        varB = sumBB - sumB**2/m
+        return cov / np.sqrt(varA*varB)
+
+# KLL quantile sketch (Karnin, Lang and Liberty 2016) of a stream of values.
+# Values are kept in levels of compactors, a value at level h standing for 2^h
+# values of the stream. A level over its capacity is sorted and every other
+# value, from a random offset, is promoted to the next level. Capacities decrease
+# geometrically from the top level down, so the sketch holds O(k) values, and two
+# sketches are merged by joining their levels and compacting again.
+class KLLSketch:
+
+    def __init__(self, k=400, rng=None):
+        self.k = k
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.levels = [np.zeros(0)]
+        self.n = 0
+
+    def capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2/3)**(len(self.levels) - 1 - h))))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self.compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self.compress()
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                level = np.sort(self.levels[h])
+                # An odd value out stays at this level
+                even = len(level) - len(level) % 2
+                offset = self.rng.integers(2)
+                self.levels[h+1] = np.concatenate([self.levels[h+1], level[offset:even:2]])
+                self.levels[h] = level[even:]
+                # Adding a level lowers the capacities of the levels below
+                h = 0
+            else:
+                h += 1
+
+    # The values at the given percentiles. While nothing has been compacted the
+    # sketch holds the whole stream, and these are linear-interpolated as
+    # np.percentile does; otherwise they are the weighted ranks of the sketch.
+    def percentiles(self, percentiles):
+        if self.n == 0:
+            return np.full(len(percentiles), np.nan)
+        if len(self.levels) == 1:
+            return np.percentile(self.levels[0], percentiles)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2**h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values)
+        cumWeights = np.cumsum(weights[order])
+        ranks = np.asarray(percentiles, dtype=float) / 100.0 * cumWeights[-1]
+        return values[order][np.minimum(np.searchsorted(cumWeights, ranks), len(values) - 1)]
+
+# Values of each profile at the given percentiles, from one KLL sketch per
+# profile. Returns an [S x P] array for P percentiles.
+class StreamingPercentiles:
+
+    def __init__(self, S, percentiles, k=400, seed=0):
+        self.percentiles = list(percentiles)
+        rng = np.random.default_rng(seed)
+        self.sketches = [KLLSketch(k, rng) for s in range(S)]
+
+    def update(self, profiles, valid=None):
+        for s, sketch in enumerate(self.sketches):
+            sketch.update(profiles[s] if valid is None else profiles[s, valid[s]])
+
+    def merge(self, other):
+        for sketch, otherSketch in zip(self.sketches, other.sketches):
+            sketch.merge(otherSketch)
+
+    def finalize(self):
+        return np.array([sketch.percentiles(self.percentiles) for sketch in self.sketches])
+
+# Generalized load factor (mean over the load at each of the given percentiles)
+# of each profile. Returns an [S x P] array for P percentiles.
+class StreamingLoadFactorPercentile:
+
+    def __init__(self, S, percentiles, k=400, seed=0):
+        self.moments = StreamingMoments(S)
+        self.values = StreamingPercentiles(S, percentiles, k, seed)
+
+    def update(self, profiles, valid=None):
+        self.moments.update(profiles, valid)
+        self.values.update(profiles, valid)
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.values.merge(other.values)
+
+    def finalize(self):
+        return self.moments.mean[:, np.newaxis] / self.values.finalize()
+
+# Computes streaming statistics over an iterable of [S x t] chunks of aggregate
+# profiles, as (profiles, valid) pairs, and returns their finalized values.
+def streamStatistics(statistics, chunks):
+    for profiles, valid in chunks:
+        for stat in statistics:
+            stat.update(profiles, valid)
+    return [stat.finalize() for stat in statistics]
+
+# Yields the [S x t] aggregate profiles of a batch of combinations, and their
+# [S x t] masks of valid time points, over successive chunks of chunkSize time
+# points of the [N x T] loadMatrix, so that only one chunk of the profiles is
+# held at a time
+def profileChunks(loadMatrix, combinations, mask=None, chunkSize=10080):
+    T = np.shape(loadMatrix)[1]
+    for start in range(0, T, chunkSize):
+        stop = min(start + chunkSize, T)
+        if mask is None:
+            yield bls.aggregateProfiles(loadMatrix[:, start:stop], combinations), None
+        else:
+            yield bls.aggregateProfiles(loadMatrix[:, start:stop], combinations, mask[:, start:stop])
@@ -0,0 +1,79 @@
+######################################################
+# This file contains a generator of synthetic household loads,
+# so that the aggregation pipeline can be run and timed offline
+# without the Kitobo or Pecan Street databases.
+#
+# Each household follows a diurnal shape (by default a morning
+# and a larger evening peak over a base load), scaled by its own
+# lognormal mean load and shifted by its own phase, with
+# multiplicative noise and short appliance spikes. Readings are
+# dropped at random at a given missing-data rate.
+
+# Imports
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+from LoadCache import LoadCache
+
+# Minutes between readings of each sampling interval
+intervalMinutes = {
+    'minute': 1,
+    'fiveMinutes': 5,
+    'fifteenMinutes': 15,
+    'hour': 60,
+}
+
+# Relative load at each hour of the day (a float array in [0, 24))
+def diurnalShape(hours):
+    morning = np.exp(-((hours - 7.5)/1.5)**2)
+    evening = np.exp(-((hours - 19.5)/2.5)**2)
+    return 0.4 + 0.6*morning + 1.0*evening
+
+# Returns the [N x T] loads (in W) of N synthetic households at T timestamps
+# of the sampling interval from startTime, an [N x T] mask that is False where
+# a reading is missing (the load is then 0), and the timestamps as naive UTC
+# datetimes. shape is a function from hour of day to relative load.
+def syntheticLoads(N, T, samplingInterval='fiveMinutes', missingRate=0.0, shape=diurnalShape,
+                   startTime=datetime(2017, 3, 1), seed=0):
+    rng = np.random.default_rng(seed)
+    step = intervalMinutes[samplingInterval]
+    times = [startTime + timedelta(minutes=step*j) for j in range(T)]
+
+    hours = (np.arange(T)*step/60.0) % 24
+    meanLoad = rng.lognormal(np.log(300), 0.5, size=N)
+    phase = rng.normal(0, 1, size=N)
+    loads = meanLoad[:, np.newaxis] * shape((hours[np.newaxis, :] - phase[:, np.newaxis]) % 24)
+    loads *= rng.lognormal(0, 0.3, size=(N, T))
+
+    # Appliance spikes of 1 to 2 kW lasting about half an hour
+    spikes = rng.random((N, T)) < step/(6*60.0)
+    duration = max(1, 30 // step)
+    spikeLoad = np.where(spikes, rng.uniform(1000, 2000, size=(N, T)), 0)
+    loads += np.apply_along_axis(lambda x: np.convolve(x, np.ones(duration))[:T], 1, spikeLoad)
+
+    mask = rng.random((N, T)) >= missingRate
+    return np.where(mask, loads, 0), mask, times
+
+# The synthetic loads as a [T x N] DataFrame with a DatetimeIndex, NaN where a
+# reading is missing, as returned by getNLoads for the Pecan Street analysis
+def syntheticFrame(N, T, samplingInterval='fiveMinutes', missingRate=0.0, shape=diurnalShape,
+                   startTime=datetime(2017, 3, 1), seed=0):
+    loads, mask, times = syntheticLoads(N, T, samplingInterval, missingRate, shape, startTime, seed)
+    return pd.DataFrame(np.where(mask, loads, np.nan).T, index=pd.DatetimeIndex(times),
+                        columns=['home{}'.format(i) for i in range(N)])
+
+# Writes synthetic loads to a LoadCache entry that CacheBackend can read, and
+# returns the name of the entry
+def writeSyntheticCache(directory, N, T, samplingInterval='fiveMinutes', missingRate=0.0, shape=diurnalShape,
+                        startTime=datetime(2017, 3, 1), seed=0):
+    loads, mask, times = syntheticLoads(N, T, samplingInterval, missingRate, shape, startTime, seed)
+    cache = LoadCache(directory)
+    endTime = times[-1] + timedelta(minutes=intervalMinutes[samplingInterval])
+    name = cache.entryName(samplingInterval, startTime, endTime)
+    cache.write(name, loads, mask, times, ['device{}'.format(i) for i in range(N)], {
+        'samplingInterval': samplingInterval,
+        'startTime': startTime.isoformat(),
+        'endTime': endTime.isoformat()
+    })
+    return name
@@ -0,0 +1,178 @@
+import argparse
+import itertools
+import json
+import tempfile
+import tracemalloc
+from time import perf_counter
+import numpy as np
+
+from AggregateStatisticCalculator import AggregateStatisticCalculator
+from KitoboBackends import CacheBackend
+from KitoboDatabase import KitoboDatabase, profileFields
+import BatchedLoadStatistics as bls
+import SyntheticLoads
+
+#Times the aggregation-sampling pipeline on synthetic loads, fully offline: the
+#Pecan Street aggLoadStats paths on a synthetic frame, and the Kitobo sampling loops
+#and calculate* methods on a synthetic load cache with the results kept in process.
+#For every combination of the numbers of users, timestamps and samples per level
+#given, reports the samples per second and peak memory of each path, and the
+#latency of each statistic. The results are written to JSON, and compared with
+#those of a previous run with --compare, e.g.
+#  python benchmarkSampling.py --N 10 20 40 --T 2016 8064 --output bench.json
+#  python benchmarkSampling.py --N 10 20 40 --T 2016 8064 --compare bench.json
+
+statistics = [
+    ('loadFactor', []),
+    ('cov', []),
+    ('autocorrelation', [1]),
+    ('acf', [[1, 12, 288]]),
+    ('loadFactorPercentile', [[50, 90, 99]]),
+]
+
+#Runs f(), returning its result, the wall time in seconds and the peak memory
+#allocated while it ran, in MB. Tracing allocations slows down Python-heavy paths
+#more than NumPy-heavy ones, so times are comparable between runs, not absolute
+def measure(f):
+    tracemalloc.start()
+    start = perf_counter()
+    result = f()
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak/2**20
+
+def record(path, config, samples, seconds, peakMB, **extra):
+    r = dict(config, path=path, samples=samples, seconds=seconds,
+             samplesPerSec=samples/seconds if seconds > 0 else float('inf'), peakMB=peakMB)
+    r.update(extra)
+    print('{:<24}N={N:<5}T={T:<7}samplesPerLevel={samplesPerLevel:<6}{:>10.1f} samples/s{:>10.1f} MB'.format(
+        path, r['samplesPerSec'], peakMB, **config))
+    return r
+
+#Aggregation levels timed: a few spread from 1 to N
+def aggregationLevels(N):
+    return sorted(set(np.linspace(1, N, 5).astype(int).tolist()))
+
+def benchmarkPecan(config):
+    try:
+        import AggregateStatisticCalculator_Pecan as pecan
+    except ImportError as e:
+        print('Skipping aggLoadStats: ' + str(e))
+        return []
+
+    loadMat = SyntheticLoads.syntheticFrame(config['N'], config['T'], config['samplingInterval'],
+                                            config['missingRate'], seed=config['seed']).T
+    levels = aggregationLevels(config['N'])
+    statList = [pecan.meanTotalLoadPerUser, pecan.cvLoad, pecan.loadFactor]
+    results = []
+    for path, f in [('aggLoadStats', pecan.aggLoadStats), ('aggLoadStatsBatched', pecan.aggLoadStatsBatched)]:
+        R, seconds, peakMB = measure(lambda: f(loadMat, levels, statList, samplesPerLevel=config['samplesPerLevel']))
+        samples = int(np.sum(~np.isnan(R[:, :, 0])))
+        results.append(record(path, config, samples, seconds, peakMB))
+    return results
+
+def benchmarkSamplingLoops(config, cacheDirectory):
+    results = []
+    for path, run in [
+        ('generateSamples', lambda c: c.generateSamples()),
+        ('generateSamplesBatched', lambda c: c.generateSamples(batchSize=100)),
+    ]:
+        np.random.seed(config['seed'])
+        #tol=0 never converges, so every level draws its full budget
+        calculator = AggregateStatisticCalculator(CacheBackend(cacheDirectory), config['samplingInterval'],
+            [s for s, p in statistics], [p for s, p in statistics],
+            maxIterations=config['samplesPerLevel'], tol=0, inMemory=True)
+        calculator.connect()
+        result, seconds, peakMB = measure(lambda: run(calculator))
+        samples = sum(len(calculator.db.getSampleList(k)) for k in range(1, calculator.N+1))
+        calculator.disconnect()
+        results.append(record(path, config, samples, seconds, peakMB))
+    return results
+
+#Latency of each statistic, through the calculate* methods of KitoboDatabase (one
+#sample at a time) and through profileFields on a batch of aggregate profiles
+def benchmarkStatistics(config, cacheDirectory):
+    db = KitoboDatabase(CacheBackend(cacheDirectory))
+    db.connect()
+    db.setupLoadAggregationCalculations(samplingInterval=config['samplingInterval'])
+    N = db.getNumberUsers()
+    rng = np.random.default_rng(config['seed'])
+    k = max(1, N//2)
+    inds = sorted(set(tuple(int(x) for x in sorted(rng.choice(N, size=k, replace=False)))
+                      for j in range(config['samplesPerLevel'])))
+    inds = [list(ind) for ind in inds]
+
+    #Each statistic is stored in its own fields, so none of them is found already stored.
+    #Every set of users gets its own sample index, as (startTime, endTime, numUsers,
+    #sampleIndex) is a unique index of the stats collection
+    methods = {
+        'loadFactor': lambda ind, i: db.calculateAggregateLoadStats(ind, sampleIndex=i),
+        'cov': lambda ind, i: db.calculateCOV(ind, sampleIndex=i),
+        'autocorrelation': lambda ind, i: db.calculateAutocorrelation(ind, 1, sampleIndex=i),
+        'acf': lambda ind, i: db.calculateAutocorrelationFunction(ind, [1, 12, 288], sampleIndex=i),
+        'loadFactorPercentile': lambda ind, i: db.calculateLoadFactorPercentile(ind, [50, 90, 99], sampleIndex=i),
+    }
+    profiles, valid = bls.aggregateProfiles(db.loadMatrix, inds, db.loadMask)
+
+    calculateMs = {}
+    batchMs = {}
+    for statistic in statistics:
+        name = statistic[0]
+        start = perf_counter()
+        for i, ind in enumerate(inds):
+            methods[name](ind, i)
+        calculateMs[name] = 1000*(perf_counter() - start)/len(inds)
+
+        start = perf_counter()
+        profileFields(profiles, valid, [k]*len(inds), [statistic])
+        batchMs[name] = 1000*(perf_counter() - start)/len(inds)
+    db.disconnect()
+
+    print('{:<24}{:>16}{:>16}'.format('statistic', 'calculate (ms)', 'batched (ms)'))
+    for name in calculateMs:
+        print('{:<24}{:>16.3f}{:>16.3f}'.format(name, calculateMs[name], batchMs[name]))
+    return [dict(config, path='statisticLatency', calculateMs=calculateMs, batchMs=batchMs)]
+
+#Key of a result, to match it with the same path and configuration of another run
+def resultKey(r):
+    return (r['path'], r['N'], r['T'], r['samplesPerLevel'], r['samplingInterval'], r['missingRate'])
+
+#Prints the change in speed of every result against a previous run
+def compare(results, previousFile):
+    with open(previousFile) as f:
+        previous = {resultKey(r): r for r in json.load(f)['results']}
+    print('{:<24}{:>6}{:>8}{:>8}{:>12}'.format('path', 'N', 'T', 'samples', 'speedup'))
+    for r in results:
+        p = previous.get(resultKey(r))
+        if p is None or 'samplesPerSec' not in r:
+            continue
+        print('{:<24}{:>6}{:>8}{:>8}{:>12.2f}'.format(
+            r['path'], r['N'], r['T'], r['samplesPerLevel'], r['samplesPerSec']/p['samplesPerSec']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation-sampling pipeline on synthetic loads')
+    parser.add_argument('--N', type=int, nargs='+', default=[10, 20], help='numbers of users')
+    parser.add_argument('--T', type=int, nargs='+', default=[2016], help='numbers of timestamps')
+    parser.add_argument('--samplesPerLevel', type=int, nargs='+', default=[50], help='samples per aggregation level')
+    parser.add_argument('--samplingInterval', default='fiveMinutes', choices=list(SyntheticLoads.intervalMinutes))
+    parser.add_argument('--missingRate', type=float, default=0.0, help='fraction of missing readings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmarkSampling.json', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = []
+    for N, T, samplesPerLevel in itertools.product(args.N, args.T, args.samplesPerLevel):
+        config = {'N': N, 'T': T, 'samplesPerLevel': samplesPerLevel, 'samplingInterval': args.samplingInterval,
+                  'missingRate': args.missingRate, 'seed': args.seed}
+        results += benchmarkPecan(config)
+        with tempfile.TemporaryDirectory() as cacheDirectory:
+            SyntheticLoads.writeSyntheticCache(cacheDirectory, N, T, args.samplingInterval, args.missingRate, seed=args.seed)
+            results += benchmarkSamplingLoops(config, cacheDirectory)
+            results += benchmarkStatistics(config, cacheDirectory)
+
+    with open(args.output, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=1)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,76 @@
+import sys
+import numpy as np
+from time import perf_counter
+
+from KitoboDatabase import KitoboDatabase, profileFields
+
+#Compares, per statistic, computing it client side (fetching the aggregate series
+#with getAggregatePower) with computing it in the Mongo pipeline (getServerSideStats),
+#and checks that both give the same fields. This needs a live mongod (MongoDB 7.0+):
+#mongomock has no $setWindowFields or $percentile, so the pipeline is not checked
+#offline. Exits with status 1 if a field differs by more than its tolerance
+statistics = [
+    ('loadFactor', []),
+    ('cov', []),
+    ('autocorrelation', [1]),
+    ('acf', [[1, 12, 288]]),
+    ('loadFactorPercentile', [[50, 90, 99]]),
+]
+aggregationLevels = [1, 5, 10, 20]
+samplesPerLevel = 10
+#Relative tolerance of the server fields: $percentile is approximate, the rest exact
+#up to rounding
+tolerance = 1e-6
+percentileTolerance = 0.05
+
+#Largest relative difference of the fields of a statistic between client and server,
+#and whether it is within tolerance
+def compareFields(client, server):
+    worst = 0
+    ok = True
+    for name, value in client.items():
+        if name == 'numUsers':
+            continue
+        diff = np.max(np.abs(np.subtract(server[name], value)) / np.maximum(np.abs(value), 1e-12))
+        worst = max(worst, float(diff))
+        ok = ok and diff <= (percentileTolerance if name.startswith('loadFactor_') else tolerance)
+    return worst, ok
+
+db = KitoboDatabase()
+db.connect()
+db.setupLoadAggregationCalculations(serverSide=True)
+N = db.getNumberUsers()
+
+rng = np.random.default_rng(0)
+inds = [[int(x) for x in sorted(rng.choice(N, size=k, replace=False))]
+        for k in aggregationLevels if k <= N for j in range(samplesPerLevel)]
+
+print('{:<22}{:>12}{:>12}{:>10}{:>14}'.format('statistic', 'client (ms)', 'server (ms)', 'speedup', 'max rel diff'))
+allOk = True
+for statistic in statistics:
+    clientTime = 0
+    serverTime = 0
+    worst = 0
+    for ind in inds:
+        start = perf_counter()
+        time, totalPower = db.getAggregatePower(ind)
+        client = profileFields(np.atleast_2d(totalPower), None, [len(ind)], [statistic])[0]
+        clientTime += perf_counter() - start
+
+        start = perf_counter()
+        server = db.getServerSideStats(ind, [statistic])
+        serverTime += perf_counter() - start
+
+        diff, ok = compareFields(client, server)
+        worst = max(worst, diff)
+        if not ok:
+            allOk = False
+            print('Mismatch for {} of users {}: client {}, server {}'.format(statistic[0], ind, client, server))
+
+    clientTime = 1000*clientTime/len(inds)
+    serverTime = 1000*serverTime/len(inds)
+    print('{:<22}{:>12.1f}{:>12.1f}{:>10.2f}{:>14.2e}'.format(statistic[0], clientTime, serverTime, clientTime/serverTime, worst))
+
+db.disconnect()
+if not allOk:
+    sys.exit(1)
@@ -0,0 +1,81 @@
+######################################################
+# This file checks PecanStreetLoader against a local SQLite
+# table of readings and a stand-in pecanpy module, so that the
+# fetchers and the LoadCache round trip run without access to
+# the Pecan Street database. Run with python -m pytest.
+
+# Imports
+from datetime import datetime, timedelta
+import sys
+import types
+import numpy as np
+import pandas as pd
+import pytest
+
+from LoadCache import LoadCache
+from PecanStreetLoader import PecanStreetLoader, pecanpyFetcher, sqlFetcher
+
+sqlalchemy = pytest.importorskip('sqlalchemy')
+
+startTime = datetime(2015, 1, 1)
+endTime = datetime(2015, 1, 2)
+times = [startTime + timedelta(hours=h) for h in range(24)]
+
+# Hourly loads of homes 1 to 4. Home 2 misses a reading, so it fails the
+# quality filter, and home 5 has no readings at all
+def homeLoads():
+    loads = {home: [home + h/24 for h in range(24)] for home in [1, 2, 3, 4]}
+    loads[2][5] = None
+    return loads
+
+# A SQLite database file with a table of readings (dataid, localminute, use)
+def readingsEngine(path):
+    engine = sqlalchemy.create_engine('sqlite:///' + str(path))
+    with engine.begin() as con:
+        con.execute(sqlalchemy.text('CREATE TABLE readings (dataid INTEGER, localminute TIMESTAMP, use REAL)'))
+        con.execute(sqlalchemy.text('INSERT INTO readings VALUES (:dataid, :localminute, :use)'),
+                    [{'dataid': home, 'localminute': t.strftime('%Y-%m-%d %H:%M:%S'), 'use': x}
+                     for home, loads in homeLoads().items() for t, x in zip(times, loads)])
+    return engine
+
+def checkLoads(df, homes):
+    assert list(df.columns) == homes
+    assert len(df) == len(times)
+    for home in homes:
+        np.testing.assert_allclose(df[home].values, homeLoads()[home])
+
+def test_sqlFetcher(tmp_path):
+    loader = PecanStreetLoader(readingsEngine(tmp_path / 'pecan.db'), sqlFetcher('readings'), maxWorkers=2)
+    checkLoads(loader.getNLoads(2, [5, 2, 1, 3, 4], startTime, endTime), [1, 3])
+    # Fewer good homes than asked for
+    checkLoads(loader.getNLoads(5, [5, 2, 1, 3, 4], startTime, endTime), [1, 3, 4])
+
+def test_cachedHomesAreNotRefetched(tmp_path):
+    cache = LoadCache(str(tmp_path / 'cache'))
+    loader = PecanStreetLoader(readingsEngine(tmp_path / 'pecan.db'), sqlFetcher('readings'), cache, maxWorkers=2)
+    first = loader.getNLoads(3, [5, 2, 1, 3, 4], startTime, endTime)
+    # Every fetched home has an entry, the ones failing the quality filter too
+    assert len(cache.names()) == 5
+
+    # The same loads come back from the cache, without a readings table
+    empty = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'empty.db'))
+    cached = PecanStreetLoader(empty, sqlFetcher('readings'), cache, maxWorkers=2).getNLoads(3, [5, 2, 1, 3, 4], startTime, endTime)
+    checkLoads(cached, [1, 3, 4])
+    pd.testing.assert_frame_equal(cached, first)
+
+def test_pecanpyFetcher(tmp_path, monkeypatch):
+    calls = []
+
+    # Stand-in for pecanpy.read_electricity_egauge_query
+    def query(con, schema, home, start, end, columns, rez):
+        calls.append((schema, home, columns, rez))
+        loads = homeLoads().get(home)
+        if loads is None:
+            return pd.DataFrame({'use': []}, index=pd.DatetimeIndex([]))
+        return pd.DataFrame({'use': np.array(loads, dtype=float), 'grid': 0.0}, index=pd.DatetimeIndex(times))
+
+    monkeypatch.setitem(sys.modules, 'pecanpy', types.SimpleNamespace(read_electricity_egauge_query=query))
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'pecan.db'))
+    loader = PecanStreetLoader(engine, pecanpyFetcher(), maxWorkers=2)
+    checkLoads(loader.getNLoads(2, [2, 1, 3], startTime, endTime), [1, 3])
+    assert sorted(calls) == [('university', home, 'all', 'H') for home in [1, 2, 3]]